@@ -1,27 +1,21 @@
-import math
-from lib_prompt_fusion import interpolation_functions
-from lib_prompt_fusion.t_scaler import scale_t
-from lib_prompt_fusion import interpolation_tensor
+from lib_prompt_fusion import prompt_plan
 
 
-class ListExpression:
-    def __init__(self, expressions):
-        self.__expressions = expressions
-
+class Expression:
     def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
-        if not self.__expressions:
-            return
+        plan = prompt_plan.compile_prompt(self, context)
+        plan.extend_tensor(tensor_builder, steps_range, total_steps, is_hires, use_old_scheduling)
 
-        def expr_extend_tensor(expr):
-            expr.extend_tensor(tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling)
 
-        expr_extend_tensor(self.__expressions[0])
-        for expression in self.__expressions[1:]:
-            tensor_builder.append(' ')
-            expr_extend_tensor(expression)
+class ListExpression(Expression):
+    def __init__(self, expressions):
+        self.__expressions = expressions
+
+    def compile(self, compiler, context):
+        return compiler.add_node(prompt_plan.ListNode(tuple(compiler.compile(expr, context) for expr in self.__expressions)))
 
 
-class InterpolationExpression:
+class InterpolationExpression(Expression):
     @staticmethod
     def create(exprs, steps, function_name):
         if function_name == "mean":
@@ -40,66 +34,15 @@ class InterpolationExpression:
         self.__steps = steps
         self.__function_name = function_name if function_name is not None else 'linear'
 
-    def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
-        def tensor_updater(expr):
-            return lambda t: expr.extend_tensor(t, steps_range, total_steps, context, is_hires, use_old_scheduling)
-
-        tensor_builder.extrude(
-            [tensor_updater(expr) for expr in self.__expressions],
-            self.get_interpolation_function(steps_range, total_steps, context, is_hires, use_old_scheduling))
-
-    def get_interpolation_function(self, steps_range, total_steps, context, is_hires, use_old_scheduling):
-        steps = list(self.__steps)
-        if steps[0] is None:
-            steps[0] = LiftExpression(str(steps_range[0] - 1))
-        if steps[-1] is None:
-            steps[-1] = LiftExpression(str(steps_range[1] - 1))
-
-        for i, step in enumerate(steps):
-            if step is None:
-                continue
-
-            step = _eval_int_or_float(step, steps_range, total_steps, context, is_hires, use_old_scheduling)
-
-            if use_old_scheduling and 0 < step < 1:
-                step *= total_steps
-            elif not use_old_scheduling and isinstance(step, float):
-                step = (step - int(is_hires)) * total_steps
-            else:
-                step += 1
+    def compile(self, compiler, context):
+        return compiler.add_node(prompt_plan.InterpolationNode(
+            tuple(compiler.compile(expr, context) for expr in self.__expressions),
+            compiler.add_function(prompt_plan.InterpolationFunctionDescriptor(
+                self.__function_name,
+                _compile_optional_numbers(compiler, self.__steps, context)))))
 
-            steps[i] = int(step)
 
-        i = 1
-        while i < len(steps):
-            none_len = 0
-            while steps[i + none_len] is None:
-                none_len += 1
-
-            min_step, max_step = steps[i - 1], steps[i + none_len]
-
-            for j in range(none_len):
-                steps[i + j] = min_step + (max_step - min_step) * (j + 1) / (none_len + 1)
-
-            i += 1 + none_len
-
-        interpolation_function = {
-            'linear': interpolation_functions.compute_linear,
-            'bezier': interpolation_functions.compute_bezier,
-            'catmull': interpolation_functions.compute_catmull,
-        }[self.__function_name]
-
-        def steps_scale_t(conds, params: interpolation_tensor.InterpolationParams):
-            scaled_t = (params.t * total_steps - steps[0]) / max(1, steps[-1] - steps[0])
-            scaled_t = scale_t(scaled_t, steps)
-
-            new_params = interpolation_tensor.InterpolationParams(scaled_t, *params[1:])
-            return interpolation_function(conds, new_params)
-
-        return steps_scale_t
-
-
-class AverageExpression:
+class AverageExpression(Expression):
     def __init__(self, expressions, weights):
         if len(expressions) < len(weights):
             raise ValueError
@@ -107,118 +50,44 @@ class AverageExpression:
         self.__expressions = expressions
         self.__weights = weights
 
-    def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
-        def tensor_updater(expr):
-            return lambda t: expr.extend_tensor(t, steps_range, total_steps, context, is_hires, use_old_scheduling)
-
-        tensor_builder.extrude(
-            [tensor_updater(expr) for expr in self.__expressions],
-            self.get_interpolation_function(steps_range, total_steps, context, is_hires, use_old_scheduling))
-
-    def get_interpolation_function(self, steps_range, total_steps, context, is_hires, use_old_scheduling):
-        weights = [
-            _eval_int_or_float(weight, steps_range, total_steps, context, is_hires, use_old_scheduling) if weight is not None else None
-            for weight in self.__weights
-        ]
-        explicit_weights = [weight for weight in weights if weight is not None]
-        weights = [
-            weight / sum(explicit_weights) * len(explicit_weights) / len(self.__expressions)
-            if weight is not None
-            else 1 / len(self.__expressions)
-            for weight in weights
-        ]
-        weights.extend(1 / len(self.__expressions) for _ in range(len(self.__expressions) - len(weights)))
-
-        def interpolation_function(conds, _params):
-            total = None
-            for cond, weight in zip(conds, weights):
-                cond *= weight
-                if total is None:
-                    total = cond
-                else:
-                    total += cond
-
-            return total
-
-        return interpolation_function
-
-
-class AlternationExpression:
+    def compile(self, compiler, context):
+        return compiler.add_node(prompt_plan.InterpolationNode(
+            tuple(compiler.compile(expr, context) for expr in self.__expressions),
+            compiler.add_function(prompt_plan.InterpolationFunctionDescriptor(
+                'mean',
+                _compile_optional_numbers(compiler, self.__weights, context)))))
+
+
+class AlternationExpression(Expression):
     def __init__(self, expressions, speed):
         self.__expressions = expressions
         self.__speed = speed
 
-    def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
+    def compile(self, compiler, context):
+        children = tuple(compiler.compile(expr, context) for expr in self.__expressions)
         if self.__speed is None:
-            speed = None
-        else:
-            speed = _eval_int_or_float(self.__speed, steps_range, total_steps, context, is_hires, use_old_scheduling)
-
-        if speed is None:
-            tensor_builder.append('[')
-            for expr_i, expr in enumerate(self.__expressions):
-                if expr_i >= 1:
-                    tensor_builder.append('|')
-                expr.extend_tensor(tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling)
-            tensor_builder.append(']')
-            return
-
-        def tensor_updater(expr):
-            return lambda t: expr.extend_tensor(t, steps_range, total_steps, context, is_hires, use_old_scheduling)
-
-        exprs = self.__expressions + [self.__expressions[0]]
-
-        tensor_builder.extrude(
-            [tensor_updater(expr) for expr in exprs],
-            self.get_interpolation_function(speed, exprs, steps_range, total_steps))
+            return compiler.add_node(prompt_plan.AlternationNode(children))
 
-    def get_interpolation_function(self, speed, exprs, steps_range, total_steps):
-        def compute_wrap(control_points, params: interpolation_tensor.InterpolationParams):
-            wrapped_t = math.fmod((params.t * total_steps - steps_range[0]) / (len(exprs) - 1) * speed, 1.0)
-            if wrapped_t < 0:
-                wrapped_t = wrapped_t + 1
-            new_params = interpolation_tensor.InterpolationParams(wrapped_t, *params[1:])
-            return interpolation_functions.compute_linear(control_points, new_params)
+        return compiler.add_node(prompt_plan.InterpolationNode(
+            children + children[:1],
+            compiler.add_function(prompt_plan.InterpolationFunctionDescriptor(
+                'wrap',
+                (compiler.compile_number(self.__speed, context),)))))
 
-        return compute_wrap
 
-
-class EditingExpression:
+class EditingExpression(Expression):
     def __init__(self, expressions, step):
         assert 1 <= len(expressions) <= 2
         self.__expressions = expressions
         self.__step = step
 
-    def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
-        if self.__step is None:
-            tensor_builder.append('[')
-            for expr_i, expr in enumerate(self.__expressions):
-                expr.extend_tensor(tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling)
-                tensor_builder.append(':')
-            tensor_builder.append(']')
-            return
-
-        step = _eval_int_or_float(self.__step, steps_range, total_steps, context, is_hires, use_old_scheduling)
-        step_int = step
-        if use_old_scheduling and 0 < step < 1:
-            step_int *= total_steps
-        elif not use_old_scheduling and isinstance(step, float):
-            step_int = (step_int - int(is_hires)) * total_steps
-        else:
-            step_int += 1
-
-        step_int = int(step_int)
-
-        tensor_builder.append('[')
-        for expr_i, expr in enumerate(self.__expressions):
-            expr_steps_range = (steps_range[0], step_int) if expr_i == 0 and len(self.__expressions) >= 2 else (step_int, steps_range[1])
-            expr.extend_tensor(tensor_builder, expr_steps_range, total_steps, context, is_hires, use_old_scheduling)
-            tensor_builder.append(':')
-
-        tensor_builder.append(f'{step}]')
-
-
-class WeightedExpression:
+    def compile(self, compiler, context):
+        return compiler.add_node(prompt_plan.EditingNode(
+            tuple(compiler.compile(expr, context) for expr in self.__expressions),
+            _compile_optional_number(compiler, self.__step, context)))
+
+
+class WeightedExpression(Expression):
     def __init__(self, nested, weight=None, positive=True):
         self.__nested = nested
         if not positive:
@@ -227,81 +96,66 @@ class WeightedExpression:
         self.__weight = weight
         self.__positive = positive
 
-    def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
-        open_bracket, close_bracket = ('(', ')') if self.__positive else ('[', ']')
-        tensor_builder.append(open_bracket)
-        self.__nested.extend_tensor(tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling)
-
-        if self.__weight is not None:
-            tensor_builder.append(':')
-            self.__weight.extend_tensor(tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling)
-
-        tensor_builder.append(close_bracket)
+    def compile(self, compiler, context):
+        return compiler.add_node(prompt_plan.WeightedNode(
+            compiler.compile(self.__nested, context),
+            _compile_optional_number(compiler, self.__weight, context),
+            self.__positive))
 
 
-class WeightInterpolationExpression:
+class WeightInterpolationExpression(Expression):
     def __init__(self, nested, weight_begin, weight_end):
         self.__nested = nested
         self.__weight_begin = weight_begin if weight_begin is not None else LiftExpression(str(1.))
         self.__weight_end = weight_end if weight_end is not None else LiftExpression(str(1.))
 
-    def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
-        steps_range_size = steps_range[1] - steps_range[0]
-
-        weight_begin = _eval_int_or_float(self.__weight_begin, steps_range, total_steps, context, is_hires, use_old_scheduling)
-        weight_end = _eval_int_or_float(self.__weight_end, steps_range, total_steps, context, is_hires, use_old_scheduling)
-
-        for i in range(steps_range_size):
-            step = i + steps_range[0]
-
-            weight = weight_begin + (weight_end - weight_begin) * (i / max(steps_range_size - 1, 1))
-            weight_step_expr = WeightedExpression(self.__nested, LiftExpression(str(weight)))
-            if step > steps_range[0]:
-                weight_step_expr = EditingExpression([weight_step_expr], LiftExpression(str(step - 1)))
-            if step + 1 < steps_range[1]:
-                weight_step_expr = EditingExpression([weight_step_expr, ListExpression([])], LiftExpression(str(step)))
+    def compile(self, compiler, context):
+        return compiler.add_node(prompt_plan.WeightInterpolationNode(
+            compiler.compile(self.__nested, context),
+            compiler.compile_number(self.__weight_begin, context),
+            compiler.compile_number(self.__weight_end, context)))
 
-            weight_step_expr.extend_tensor(tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling)
 
-
-class DeclarationExpression:
+class DeclarationExpression(Expression):
     def __init__(self, symbol, parameters, value, target):
         self.__symbol = symbol
         self.__value = value
         self.__target = target
         self.__parameters = parameters
 
-    def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
+    def compile(self, compiler, context):
         updated_context = dict(context)
         updated_context[self.__symbol] = (self.__value, self.__parameters)
-        self.__target.extend_tensor(tensor_builder, steps_range, total_steps, updated_context, is_hires, use_old_scheduling)
+        return compiler.compile(self.__target, updated_context)
 
 
-class SubstitutionExpression:
+class SubstitutionExpression(Expression):
     def __init__(self, symbol, arguments):
         self.__symbol = symbol
         self.__arguments = arguments
 
-    def extend_tensor(self, tensor_builder, steps_range, total_steps, context, is_hires, use_old_scheduling):
+    def compile(self, compiler, context):
         updated_context = dict(context)
-        nested, parameters = context[self.__symbol]
+        try:
+            nested, parameters = context[self.__symbol]
+        except KeyError:
+            raise prompt_plan.UnknownSymbolError(self.__symbol) from None
         for argument, parameter in zip(self.__arguments, parameters):
             updated_context[parameter] = argument, []
-        nested.extend_tensor(tensor_builder, steps_range, total_steps, updated_context, is_hires, use_old_scheduling)
+        return compiler.compile_substitution(nested, updated_context)
 
 
-class LiftExpression:
+class LiftExpression(Expression):
     def __init__(self, value):
         self.__value = value
 
-    def extend_tensor(self, tensor_builder, *_args, **_kwargs):
-        tensor_builder.append(self.__value)
+    def compile(self, compiler, _context):
+        return compiler.add_node(prompt_plan.TextNode(compiler.add_fragment(self.__value)))
+
+
+def _compile_optional_number(compiler, expr, context):
+    return compiler.compile_number(expr, context) if expr is not None else None
 
 
-def _eval_int_or_float(expression, steps_range, total_steps, context, is_hires, use_old_scheduling):
-    mock_database = ['']
-    expression.extend_tensor(interpolation_tensor.InterpolationTensorBuilder(prompt_database=mock_database), steps_range, total_steps, context, is_hires, use_old_scheduling)
-    try:
-        return int(mock_database[0])
-    except ValueError:
-        return float(mock_database[0])
+def _compile_optional_numbers(compiler, exprs, context):
+    return tuple(_compile_optional_number(compiler, expr, context) for expr in exprs)
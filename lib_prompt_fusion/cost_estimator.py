@@ -0,0 +1,148 @@
+import math
+import re
+import torch
+from typing import Any, Dict, NamedTuple
+from lib_prompt_fusion import interpolation_tensor, lazy_schedule, prompt_limits, prompt_plan, prompt_parser as prompt_fusion_parser
+from modules import prompt_parser
+
+
+_conditioning_sizes = {
+    'sd1': {'crossattn': 768},
+    'sd2': {'crossattn': 1024},
+    'sdxl': {'crossattn': 2048, 'vector': 1280},
+}
+_chunk_tokens = 75
+_chunk_length = _chunk_tokens + 2
+_lazy_schedule_cache_size = 2
+
+_TOKEN = re.compile(r"'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|[^\s\w]+", re.IGNORECASE)
+_ATTENTION_SYNTAX = re.compile(r'(?<!\\)[()\[\]]|:\s*[+-]?(?:\d+(?:\.\d*)?|\.\d+)\s*(?=\))')
+_BREAK = re.compile(r'\bBREAK\b')
+
+
+class PromptCost(NamedTuple):
+    flattened_prompts: int
+    encoded_chunks: int
+    max_chunks: int
+    distinct_conds: int
+    peak_bytes: Dict[str, int]
+    interpolation_tree: Any
+
+
+def explain_prompt(prompt, total_steps, hires_steps=None, use_old_scheduling=False, model_type='sd1', dtype=torch.float32, attention_interpolation_points=0, limits=None, count_tokens=None, lazy_schedule_cache_size=_lazy_schedule_cache_size):
+    if model_type not in _conditioning_sizes:
+        raise ValueError(f'unknown model type {model_type!r}, expected one of {", ".join(_conditioning_sizes)}')
+
+    is_hires = hires_steps is not None
+    real_total_steps = hires_steps if is_hires else total_steps
+    with prompt_limits.enforce(limits if limits is not None else prompt_limits.PromptLimits()) as limits_guard:
+        plan = prompt_plan.compile_prompt(prompt_fusion_parser.parse_prompt(prompt))
+        limits_guard.check_plan(plan)
+        tensor_builder = plan.bind(real_total_steps, is_hires, use_old_scheduling, attention_interpolation_points)
+        limits_guard.check_tensor_builder(tensor_builder)
+
+    reachable_indices = tensor_builder.get_reachable_prompt_indices(real_total_steps)
+    database_prompts = [
+        tensor_builder.get_prompt(i) if i in reachable_indices else None
+        for i in range(tensor_builder.get_prompt_database_size())
+    ]
+    flattened_prompts = list(dict.fromkeys(prompt for prompt in database_prompts if prompt is not None))
+    text_schedules = _get_text_schedules(flattened_prompts, total_steps, hires_steps, use_old_scheduling)
+
+    if count_tokens is None:
+        count_tokens = estimate_token_count
+
+    chunk_counts = {}
+    flattened_schedules = {}
+    for flattened_prompt, schedules in zip(flattened_prompts, text_schedules):
+        for _, text in schedules:
+            if text not in chunk_counts:
+                chunk_counts[text] = estimate_chunk_count(text, count_tokens)
+
+        flattened_schedules[flattened_prompt] = [
+            prompt_parser.ScheduledPromptConditioning(end_at_step=end_at_step, cond=_ChunkEstimate(chunk_counts[text]))
+            for end_at_step, text in schedules
+        ]
+
+    tensor = tensor_builder.build([flattened_schedules.get(prompt) for prompt in database_prompts], _ChunkEstimate(1))
+    params_at_steps = [
+        interpolation_tensor.InterpolationParams(step / real_total_steps, step, real_total_steps, 0., 0.)
+        for step in range(real_total_steps)
+    ]
+    change_steps = {step for step in tensor.get_change_steps(params_at_steps) if 0 < step < real_total_steps}
+    distinct_conds = len(change_steps) + 1
+
+    max_chunks = max(chunk_counts.values(), default=1)
+    stored_conds = sum(len(schedules) for schedules in flattened_schedules.values())
+    if tensor.get_leaf_schedules() is None:
+        stored_conds += distinct_conds if distinct_conds <= lazy_schedule.max_batched_intervals else min(lazy_schedule_cache_size, distinct_conds)
+
+    element_size = torch.empty((), dtype=dtype).element_size()
+    peak_bytes = {
+        key: stored_conds * size * element_size * (max_chunks * _chunk_length if key == 'crossattn' else 1)
+        for key, size in _conditioning_sizes[model_type].items()
+    }
+
+    return PromptCost(
+        flattened_prompts=len(flattened_prompts),
+        encoded_chunks=sum(chunk_counts.values()),
+        max_chunks=max_chunks,
+        distinct_conds=distinct_conds,
+        peak_bytes=peak_bytes,
+        interpolation_tree=_describe_interpolation_tree(tensor_builder.get_interpolation_tree()))
+
+
+def estimate_token_count(text):
+    return sum(1 + (len(token) - 1) // 10 for token in _TOKEN.findall(text))
+
+
+def estimate_chunk_count(text, count_tokens=estimate_token_count):
+    return sum(
+        max(1, math.ceil(count_tokens(_ATTENTION_SYNTAX.sub(' ', part)) / _chunk_tokens))
+        for part in _BREAK.split(text)
+    )
+
+
+class _ChunkEstimate(NamedTuple):
+    chunks: int
+
+    def size(self, dim=0):
+        return self.chunks * _chunk_length
+
+    def resize_schedule(self, size, _empty):
+        return _ChunkEstimate(size // _chunk_length)
+
+
+def _get_text_schedules(prompts, total_steps, hires_steps, use_old_scheduling):
+    get_prompt_schedules = getattr(prompt_parser, 'get_learned_conditioning_prompt_schedules', None)
+    if get_prompt_schedules is None:
+        return [[[hires_steps or total_steps, prompt]] for prompt in prompts]
+
+    try:
+        return get_prompt_schedules(prompts, total_steps, hires_steps, use_old_scheduling)
+    except TypeError:
+        return get_prompt_schedules(prompts, total_steps)
+
+
+def _describe_interpolation_tree(tree):
+    if type(tree) is int:
+        return tree
+
+    function, children = tree
+    return {
+        'function': _get_function_name(function),
+        'children': [_describe_interpolation_tree(child) for child in children],
+    }
+
+
+def _get_function_name(function):
+    if isinstance(function, prompt_plan.CurveInterpolationFunction):
+        return function.function.__name__.removeprefix('compute_')
+
+    return _function_names.get(type(function), type(function).__name__)
+
+
+_function_names = {
+    prompt_plan.AverageInterpolationFunction: 'mean',
+    prompt_plan.WrapInterpolationFunction: 'wrap',
+}
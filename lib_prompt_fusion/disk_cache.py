@@ -0,0 +1,223 @@
+import contextlib
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import torch
+from modules import prompt_parser
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import safetensors
+    import safetensors.torch
+except ImportError:
+    safetensors = None
+
+
+_header_format = '<Q'
+_header_size = struct.calcsize(_header_format)
+_dtypes = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+class DiskConditioningCache:
+    index_file_name = 'index.json'
+    lock_file_name = 'index.lock'
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__directory = None
+        self.__max_bytes = 0
+        self.__index_updates = {}
+        self.__index_removals = set()
+
+    def configure(self, directory, max_bytes):
+        with self.__lock:
+            directory = directory or None
+            is_resized = directory != self.__directory or max_bytes < self.__max_bytes
+            if directory != self.__directory:
+                self.__directory = directory
+                self.__index_updates = {}
+                self.__index_removals = set()
+
+            self.__max_bytes = max_bytes
+            if is_resized and self.is_enabled():
+                self.__sync_index(prune=True)
+
+    def is_enabled(self):
+        return safetensors is not None and self.__directory is not None and self.__max_bytes > 0
+
+    def get(self, key, device):
+        if not self.is_enabled():
+            return None
+
+        digest = _get_digest(key)
+        with self.__lock:
+            path = self.__get_path(digest)
+            try:
+                size = os.path.getsize(path)
+                metadata, tensors = _map_tensors(path, size)
+                schedules = [
+                    prompt_parser.ScheduledPromptConditioning(cond=_load_cond(tensors, i, device), end_at_step=end_at_step)
+                    for i, end_at_step in enumerate(json.loads(metadata['end_at_steps']))
+                ]
+            except (OSError, KeyError, ValueError, RuntimeError):
+                self.__index_updates.pop(digest, None)
+                self.__index_removals.add(digest)
+                return None
+
+            self.__index_updates[digest] = {'size': size, 'last_used': time.time()}
+            self.__index_removals.discard(digest)
+            return schedules
+
+    def put(self, key, schedules):
+        if not self.is_enabled():
+            return
+
+        digest = _get_digest(key)
+        tensors = {}
+        for i, schedule in enumerate(schedules):
+            if isinstance(schedule.cond, dict):
+                for k, v in schedule.cond.items():
+                    tensors[f'{i}.{k}'] = v.detach().contiguous().cpu()
+            else:
+                tensors[f'{i}'] = schedule.cond.detach().contiguous().cpu()
+
+        metadata = {'end_at_steps': json.dumps([schedule.end_at_step for schedule in schedules])}
+        with self.__lock:
+            os.makedirs(self.__directory, exist_ok=True)
+            path = self.__get_path(digest)
+            temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            safetensors.torch.save_file(tensors, temporary_path, metadata=metadata)
+            os.replace(temporary_path, path)
+            self.__index_updates[digest] = {'size': os.path.getsize(path), 'last_used': time.time()}
+            self.__index_removals.discard(digest)
+            self.__sync_index()
+
+    def flush(self):
+        with self.__lock:
+            if self.__directory is None or not self.__index_updates and not self.__index_removals:
+                return
+
+            self.__sync_index()
+
+    def __sync_index(self, prune=False):
+        os.makedirs(self.__directory, exist_ok=True)
+        with self.__locked_index_file():
+            index = self.__read_index()
+            if prune:
+                index = {digest: entry for digest, entry in index.items() if os.path.exists(self.__get_path(digest))}
+
+            for digest in self.__index_removals:
+                index.pop(digest, None)
+            for digest, entry in self.__index_updates.items():
+                last_used = index.get(digest, {}).get('last_used', 0)
+                index[digest] = {'size': entry['size'], 'last_used': max(entry['last_used'], last_used)}
+
+            self.__evict(index)
+            self.__write_index(index)
+
+        self.__index_updates = {}
+        self.__index_removals = set()
+
+    @contextlib.contextmanager
+    def __locked_index_file(self):
+        with open(os.path.join(self.__directory, self.lock_file_name), 'a') as lock_file:
+            if fcntl is None:
+                yield
+                return
+
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __read_index(self):
+        try:
+            with open(os.path.join(self.__directory, self.index_file_name)) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+    def __write_index(self, index):
+        index_path = os.path.join(self.__directory, self.index_file_name)
+        with open(f'{index_path}.{os.getpid()}.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(f'{index_path}.{os.getpid()}.tmp', index_path)
+
+    def __evict(self, index):
+        total_bytes = sum(entry['size'] for entry in index.values())
+        for digest, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+            if total_bytes <= self.__max_bytes:
+                break
+
+            try:
+                os.remove(self.__get_path(digest))
+            except OSError:
+                pass
+
+            del index[digest]
+            total_bytes -= entry['size']
+
+    def __get_path(self, digest):
+        return os.path.join(self.__directory, f'{digest}.safetensors')
+
+
+def _get_digest(key):
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+
+def _map_tensors(path, size):
+    with open(path, 'rb') as entry_file:
+        header_length, = struct.unpack(_header_format, entry_file.read(_header_size)) if size >= _header_size else (size,)
+        if _header_size + header_length > size:
+            raise ValueError(f'{path} is not a safetensors file')
+        header = json.loads(entry_file.read(header_length))
+        if not isinstance(header, dict):
+            raise ValueError(f'{path} is not a safetensors file')
+
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=size)
+    data_offset = _header_size + header_length
+    metadata = header.pop('__metadata__', {})
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info['data_offsets']
+        if not 0 <= begin <= end <= size - data_offset:
+            raise ValueError(f'{path} is truncated')
+        tensors[name] = _view_tensor(storage, data_offset + begin, end - begin, _dtypes[info['dtype']], info['shape'])
+
+    return metadata, tensors
+
+
+def _view_tensor(storage, offset, nbytes, dtype, shape):
+    tensor = torch.empty(0, dtype=torch.uint8).set_(storage, offset, (nbytes,))
+    if offset % torch.empty((), dtype=dtype).element_size() != 0:
+        tensor = tensor.clone()
+
+    return tensor.view(dtype).reshape(shape)
+
+
+def _load_cond(tensors, index, device):
+    prefix = f'{index}.'
+    keys = [key for key in tensors.keys() if key.startswith(prefix)]
+    if not keys:
+        return tensors[f'{index}'].to(device=device)
+
+    return {key[len(prefix):]: tensors[key].to(device=device) for key in keys}
@@ -1,19 +1,48 @@
-from lib_prompt_fusion import interpolation_tensor
+import threading
+import weakref
+from modules import shared
+from lib_prompt_fusion import fusion_context, interpolation_tensor
 
 
-_empty_cond = None
+_model_empty_conds = weakref.WeakKeyDictionary()
+_model_empty_conds_lock = threading.Lock()
 
 
 def get():
-    return _empty_cond
+    return fusion_context.get().empty_cond
 
 
 def init(model):
-    global _empty_cond
+    resources_key = _get_resources_key(model)
+    try:
+        with _model_empty_conds_lock:
+            key, cond = _model_empty_conds.get(model, (None, None))
+    except TypeError:
+        fusion_context.get().empty_cond = _encode_empty_cond(model)
+        return
+
+    if cond is None or key != resources_key:
+        cond = _encode_empty_cond(model)
+        with _model_empty_conds_lock:
+            _model_empty_conds[model] = resources_key, cond
+
+    fusion_context.get().empty_cond = cond
+
+
+def _encode_empty_cond(model):
     cond = model.get_learned_conditioning([''])
     if isinstance(cond, dict):
-        cond = interpolation_tensor.DictCondWrapper({k: v[0] for k, v in cond.items()})
+        return interpolation_tensor.DictCondWrapper({k: v[0] for k, v in cond.items()}, resources={})
     else:
-        cond = interpolation_tensor.TensorCondWrapper(cond[0])
+        return interpolation_tensor.TensorCondWrapper(cond[0], resources={})
+
 
-    _empty_cond = cond
+def _get_resources_key(model):
+    checkpoint_info = getattr(model, 'sd_checkpoint_info', None)
+    return (
+        getattr(checkpoint_info, 'filename', None),
+        getattr(model, 'sd_model_hash', None),
+        shared.opts.data.get('CLIP_stop_at_last_layers', None),
+        shared.opts.data.get('emphasis', None),
+        fusion_context.get().extra_network_key,
+    )
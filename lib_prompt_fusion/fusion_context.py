@@ -0,0 +1,32 @@
+import contextvars
+import dataclasses
+from typing import Any, Dict, List, Optional
+
+
+@dataclasses.dataclass
+class FusionContext:
+    old_webui_is_negative: bool = False
+    negative_schedules: Optional[List[Any]] = None
+    negative_schedules_hires: Optional[List[Any]] = None
+    negative_schedules_key: Any = None
+    negative_schedules_hires_key: Any = None
+    extra_network_key: Any = None
+    empty_cond: Any = None
+    request_conds: Dict[Any, Any] = dataclasses.field(default_factory=dict)
+
+
+_current_context = contextvars.ContextVar('prompt_fusion_context')
+
+
+def get():
+    context = _current_context.get(None)
+    if context is None:
+        context = begin()
+
+    return context
+
+
+def begin():
+    context = FusionContext()
+    _current_context.set(context)
+    return context
@@ -1,33 +1,46 @@
-import math
 import torch
 from lib_prompt_fusion import interpolation_tensor
 
 
 def slerp_geometry(control_points, params: interpolation_tensor.InterpolationParams):
+    if params.slerp_scale == 0:
+        return linear_geometry(control_points, params)
+
     p0, p1 = control_points
+    t = _expand_t(params.t, p0)
     p0_norm = torch.linalg.norm(p0)
     p1_norm = torch.linalg.norm(p1)
 
-    similarity = torch.sum((p0 / p0_norm) * (p1 / p1_norm))
-    similarity = min(1., max(-1., float(similarity)))
-    if similarity <= params.slerp_epsilon - 1 or similarity >= 1 - params.slerp_epsilon:
-        return linear_geometry(control_points, params)
+    similarity = torch.sum((p0 / p0_norm) * (p1 / p1_norm)).nan_to_num(nan=-1.).clamp(-1., 1.)
+    is_linear = (similarity <= params.slerp_epsilon - 1) | (similarity >= 1 - params.slerp_epsilon)
 
-    angle = math.acos(float(similarity)) / 2
-
-    slerp_t = angle * (2 * params.t - 1)
-    slerp_t = math.tan(slerp_t) / math.tan(angle)
+    angle = torch.where(is_linear, torch.ones_like(similarity), torch.acos(similarity) / 2)
+    slerp_t = torch.tan(angle * (2 * t - 1)) / torch.tan(angle)
     slerp_t = (slerp_t + 1) / 2
 
     normalized_p1 = p1 / p1_norm * p0_norm
     slerp_p = p0 + (normalized_p1 - p0) * slerp_t
-    slerp_p = slerp_p / torch.linalg.norm(slerp_p) * (p0_norm + (p1_norm - p0_norm) * params.t)
+    slerp_p = slerp_p / _batch_norm(slerp_p, p0) * (p0_norm + (p1_norm - p0_norm) * t)
 
-    lerp_p = linear_geometry(control_points, params)
-    return lerp_p + (slerp_p - lerp_p) * params.slerp_scale
+    lerp_p = p0 + (p1 - p0) * t
+    return torch.where(is_linear, lerp_p, lerp_p + (slerp_p - lerp_p) * params.slerp_scale)
 
 
 def linear_geometry(control_points, params: interpolation_tensor.InterpolationParams):
     p0, p1 = control_points
-    res = p0 + (p1 - p0) * params.t
+    res = p0 + (p1 - p0) * _expand_t(params.t, p0)
     return res
+
+
+def _expand_t(t, p):
+    if not isinstance(t, torch.Tensor):
+        return t
+
+    return t.to(device=p.device, dtype=p.dtype).reshape((-1,) + (1,) * p.dim())
+
+
+def _batch_norm(batch, p):
+    if batch.dim() == p.dim():
+        return torch.linalg.norm(batch)
+
+    return torch.linalg.vector_norm(batch, dim=tuple(range(1, batch.dim())), keepdim=True)
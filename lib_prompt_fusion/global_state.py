@@ -1,23 +1,138 @@
-from typing import List, Optional
-from modules import shared, prompt_parser
-from lib_prompt_fusion import empty_cond
+import hashlib
+import itertools
+import os
+import sys
+import threading
+import weakref
+from modules import shared
+from lib_prompt_fusion import disk_cache, empty_cond, fusion_context, instrumentation, lru_cache, prompt_limits, shared_memory_cache
 
 
-old_webui_is_negative: bool = False
-negative_schedules: Optional[List[prompt_parser.ScheduledPromptConditioning]] = None
-negative_schedules_hires: Optional[List[prompt_parser.ScheduledPromptConditioning]] = None
+parse_cache = lru_cache.LruCache(
+    max_bytes=64 * 1024 * 1024,
+    size_of=lambda prompt, plan: sys.getsizeof(prompt) + plan.get_nbytes())
 
+_model_tokens = weakref.WeakKeyDictionary()
+_model_token_counter = itertools.count()
+_model_tokens_lock = threading.Lock()
 
-def get_origin_cond_at(step: int, is_hires: bool = False):
-    fallback_schedules = negative_schedules_hires if is_hires else negative_schedules
+_embeddings_fingerprint = None, None
+_embeddings_fingerprint_lock = threading.Lock()
+
+conditioning_disk_cache = disk_cache.DiskConditioningCache()
+conditioning_shared_memory_cache = shared_memory_cache.SharedMemoryConditioningCache()
+
+schedule_cache = lru_cache.LruCache(
+    max_bytes=256 * 1024 * 1024,
+    size_of=lambda _key, schedule: schedule.get_nbytes())
+
+phase_recorder = instrumentation.PhaseRecorder()
+
+
+def get_model_token(model):
+    try:
+        with _model_tokens_lock:
+            token = _model_tokens.get(model)
+            if token is None:
+                token = _model_tokens[model] = next(_model_token_counter)
+            return token
+    except TypeError:
+        return id(model)
+
+
+def get_embeddings_fingerprint():
+    global _embeddings_fingerprint
+    try:
+        from modules import sd_hijack
+        word_embeddings = sd_hijack.model_hijack.embedding_db.word_embeddings
+    except (ImportError, AttributeError):
+        return None
+
+    embeddings = tuple(word_embeddings.items())
+    with _embeddings_fingerprint_lock:
+        fingerprinted_embeddings, fingerprint = _embeddings_fingerprint
+        if fingerprinted_embeddings is not None and len(fingerprinted_embeddings) == len(embeddings) and all(
+            name == fingerprinted_name and embedding is fingerprinted_embedding
+            for (name, embedding), (fingerprinted_name, fingerprinted_embedding) in zip(embeddings, fingerprinted_embeddings)
+        ):
+            return fingerprint
+
+    digest = hashlib.sha256()
+    for name, embedding in sorted(embeddings, key=lambda item: item[0]):
+        embedding_hash = getattr(embedding, 'hash', None)
+        if embedding_hash is None and hasattr(embedding, 'checksum'):
+            embedding_hash = embedding.checksum()
+        if embedding_hash is None:
+            embedding_hash = _get_file_fingerprint(getattr(embedding, 'filename', None))
+        digest.update(repr((name, embedding_hash)).encode())
+
+    with _embeddings_fingerprint_lock:
+        _embeddings_fingerprint = embeddings, digest.hexdigest()
+    return digest.hexdigest()
+
+
+def get_networks_fingerprint(extra_network_key):
+    return tuple(
+        (network_type, name, _get_network_hash(network_type, name))
+        for network_type, params_list in extra_network_key or ()
+        for name in dict.fromkeys(params[0] for params in params_list if params)
+    )
+
+
+def _get_network_hash(network_type, name):
+    if network_type in ('lora', 'lyco'):
+        try:
+            import networks
+            network_on_disk = networks.available_network_aliases.get(name) or networks.available_networks.get(name)
+        except (ImportError, AttributeError):
+            return None
+        if network_on_disk is None:
+            return None
+
+        return getattr(network_on_disk, 'sha256', None) or _get_file_fingerprint(getattr(network_on_disk, 'filename', None))
+
+    if network_type == 'hypernet':
+        return _get_file_fingerprint(getattr(shared, 'hypernetworks', {}).get(name))
+
+    return None
+
+
+def _get_file_fingerprint(path):
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+
+    return stat.st_size, stat.st_mtime_ns
+
+
+def get_origin_schedules(is_hires: bool = False):
+    context = fusion_context.get()
+    fallback_schedules = context.negative_schedules_hires if is_hires else context.negative_schedules
     if not fallback_schedules or not shared.opts.data.get('prompt_fusion_slerp_negative_origin', False):
-        return empty_cond.get()
+        return None
+
+    return fallback_schedules
+
+
+def get_origin_schedules_key(is_hires: bool = False):
+    if get_origin_schedules(is_hires) is None:
+        return None
+
+    context = fusion_context.get()
+    return context.negative_schedules_hires_key if is_hires else context.negative_schedules_key
 
-    for schedule in fallback_schedules:
+
+def get_origin_cond_at(step: int, is_hires: bool = False):
+    return get_schedule_cond_at(get_origin_schedules(is_hires), step, empty_cond.get())
+
+
+def get_schedule_cond_at(schedules, step: int, default_cond):
+    for schedule in schedules or ():
         if schedule.end_at_step >= step:
             return schedule.cond
 
-    return empty_cond.get()
+    return default_cond
 
 
 def get_slerp_scale():
@@ -26,3 +141,52 @@ def get_slerp_scale():
 
 def get_slerp_epsilon():
     return shared.opts.data.get('prompt_fusion_slerp_epsilon', 0.0001)
+
+
+def get_parse_cache_size():
+    return int(shared.opts.data.get('prompt_fusion_parse_cache_size', 256))
+
+
+def get_attention_interpolation_points():
+    return int(shared.opts.data.get('prompt_fusion_attention_interpolation_points', 0))
+
+
+def get_schedule_cache_size():
+    return int(shared.opts.data.get('prompt_fusion_schedule_cache_size', 256) * 1024 * 1024)
+
+
+def get_lazy_schedule_cache_size():
+    return max(1, int(shared.opts.data.get('prompt_fusion_lazy_schedule_cache_size', 2)))
+
+
+def get_disk_cache_directory():
+    return shared.opts.data.get('prompt_fusion_disk_cache_dir', '')
+
+
+def get_disk_cache_size():
+    return int(shared.opts.data.get('prompt_fusion_disk_cache_size', 1024) * 1024 * 1024)
+
+
+def get_shared_memory_cache_name():
+    return shared.opts.data.get('prompt_fusion_shared_memory_cache_name', '')
+
+
+def get_shared_memory_cache_size():
+    return int(shared.opts.data.get('prompt_fusion_shared_memory_cache_size', 1024) * 1024 * 1024)
+
+
+def get_prompt_limits():
+    return prompt_limits.PromptLimits(
+        max_ast_depth=int(shared.opts.data.get('prompt_fusion_max_ast_depth', 0)),
+        max_substitution_depth=int(shared.opts.data.get('prompt_fusion_max_substitution_depth', 0)),
+        max_prompt_database_size=int(shared.opts.data.get('prompt_fusion_max_prompt_database_size', 0)),
+        max_expanded_characters=int(shared.opts.data.get('prompt_fusion_max_expanded_characters', 0)),
+        max_compile_seconds=float(shared.opts.data.get('prompt_fusion_max_compile_seconds', 0)))
+
+
+def get_instrumentation_enabled():
+    return bool(shared.opts.data.get('prompt_fusion_instrumentation_enabled', False))
+
+
+def get_instrumentation_buffer_size():
+    return max(1, int(shared.opts.data.get('prompt_fusion_instrumentation_buffer_size', 1024)))
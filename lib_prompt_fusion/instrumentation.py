@@ -0,0 +1,147 @@
+import collections
+import os
+import threading
+import time
+import torch
+from typing import Dict, NamedTuple, Optional
+
+
+class PhaseRecord(NamedTuple):
+    name: str
+    thread_id: int
+    start_us: int
+    duration_us: int
+    counts: Dict[str, int]
+    peak_bytes: Optional[int]
+
+
+class PhaseRecorder:
+    def __init__(self, capacity=1024):
+        self.__lock = threading.Lock()
+        self.__records = collections.deque(maxlen=capacity)
+        self.__enabled = False
+
+    def configure(self, enabled, capacity):
+        with self.__lock:
+            self.__enabled = enabled
+            if capacity != self.__records.maxlen:
+                self.__records = collections.deque(self.__records, maxlen=capacity)
+
+    def is_enabled(self):
+        return self.__enabled
+
+    def phase(self, name, **counts):
+        if not self.__enabled:
+            return _disabled_phase
+
+        return _Phase(self, name, counts)
+
+    def add(self, record):
+        with self.__lock:
+            self.__records.append(record)
+
+    def records(self):
+        with self.__lock:
+            return list(self.__records)
+
+    def clear(self):
+        with self.__lock:
+            self.__records.clear()
+
+    def stats(self):
+        stats = {}
+        for record in self.records():
+            phase_stats = stats.setdefault(record.name, {'calls': 0, 'total_ms': 0., 'max_ms': 0., 'peak_bytes': None, 'counts': {}})
+            duration_ms = record.duration_us / 1000
+            phase_stats['calls'] += 1
+            phase_stats['total_ms'] += duration_ms
+            phase_stats['max_ms'] = max(phase_stats['max_ms'], duration_ms)
+            if record.peak_bytes is not None:
+                phase_stats['peak_bytes'] = max(phase_stats['peak_bytes'] or 0, record.peak_bytes)
+            for key, count in record.counts.items():
+                phase_stats['counts'][key] = phase_stats['counts'].get(key, 0) + count
+
+        for phase_stats in stats.values():
+            phase_stats['mean_ms'] = phase_stats['total_ms'] / phase_stats['calls']
+
+        return stats
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        return {
+            'traceEvents': [
+                {
+                    'name': record.name,
+                    'cat': 'prompt_fusion',
+                    'ph': 'X',
+                    'ts': record.start_us,
+                    'dur': record.duration_us,
+                    'pid': pid,
+                    'tid': record.thread_id,
+                    'args': dict(record.counts, peak_bytes=record.peak_bytes),
+                }
+                for record in self.records()
+            ],
+            'displayTimeUnit': 'ms',
+        }
+
+
+class _Phase:
+    def __init__(self, recorder, name, counts):
+        self.__recorder = recorder
+        self.__name = name
+        self.__counts = counts
+        self.__record_function = torch.profiler.record_function(f'prompt_fusion::{name}')
+        self.__memory_before = None
+        self.__start_ns = 0
+
+    def set(self, **counts):
+        self.__counts.update(counts)
+
+    def __enter__(self):
+        self.__record_function.__enter__()
+        self.__memory_before = _get_memory_stats()
+        self.__start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end_ns = time.perf_counter_ns()
+        peak_bytes = None
+        if self.__memory_before is not None:
+            memory_before, max_memory_before = self.__memory_before
+            memory_after, max_memory_after = _get_memory_stats()
+            if max_memory_after > max_memory_before:
+                peak_bytes = max_memory_after - memory_before
+            else:
+                peak_bytes = max(0, memory_after - memory_before)
+
+        self.__recorder.add(PhaseRecord(
+            name=self.__name,
+            thread_id=threading.get_ident(),
+            start_us=self.__start_ns // 1000,
+            duration_us=(end_ns - self.__start_ns) // 1000,
+            counts=self.__counts,
+            peak_bytes=peak_bytes))
+        self.__record_function.__exit__(*exc_info)
+        return False
+
+
+class _DisabledPhase:
+    def set(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_disabled_phase = _DisabledPhase()
+
+
+def _get_memory_stats():
+    if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+
+    return torch.cuda.memory_allocated(), torch.cuda.max_memory_allocated()
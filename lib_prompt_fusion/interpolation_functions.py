@@ -1,20 +1,20 @@
-import copy
 import math
+import torch
 from lib_prompt_fusion import interpolation_tensor, geometries
 
 
-def compute_linear(control_points, params: interpolation_tensor.InterpolationParams):
+def compute_linear(control_points, params: interpolation_tensor.InterpolationParams, segment=None):
     if len(control_points) <= 2:
         return geometries.slerp_geometry(control_points, params)
     else:
-        target_curve = min(int(params.t * (len(control_points) - 1)), len(control_points) - 1)
+        target_curve, local_t = segment if segment is not None else get_segment(len(control_points), params.t)
         cp0 = control_points[target_curve]
         cp1 = control_points[target_curve + 1] if target_curve + 1 < len(control_points) else control_points[-1]
-        new_params = interpolation_tensor.InterpolationParams(math.fmod(params.t * (len(control_points) - 1), 1.), *params[1:])
+        new_params = interpolation_tensor.InterpolationParams(local_t, *params[1:])
         return geometries.slerp_geometry([cp0, cp1], new_params)
 
 
-def compute_bezier(control_points, params: interpolation_tensor.InterpolationParams):
+def compute_bezier(control_points, params: interpolation_tensor.InterpolationParams, _segment=None):
     def compute_casteljau(ps, size):
         for i in reversed(range(1, size)):
             for j in range(i):
@@ -26,15 +26,20 @@ def compute_bezier(control_points, params: interpolation_tensor.InterpolationPar
         return control_points[0]
     elif len(control_points) == 2:
         return geometries.slerp_geometry(control_points, params)
-    copied_control_points = copy.deepcopy(control_points)
-    return compute_casteljau(copied_control_points, len(copied_control_points))
+    elif params.slerp_scale == 0:
+        return compute_weighted_sum(control_points, get_bernstein_weights(len(control_points), params.t))
+    return compute_casteljau(list(control_points), len(control_points))
 
 
-def compute_catmull(control_points, params: interpolation_tensor.InterpolationParams):
+def compute_catmull(control_points, params: interpolation_tensor.InterpolationParams, segment=None):
     if len(control_points) <= 2:
         return compute_linear(control_points, params)
     else:
-        target_curve = min(int(params.t * (len(control_points) - 1)), len(control_points) - 1)
+        target_curve, local_t = segment if segment is not None else get_segment(len(control_points), params.t)
+        new_params = interpolation_tensor.InterpolationParams(local_t, *params[1:])
+        if params.slerp_scale == 0:
+            return compute_weighted_sum(control_points, get_catmull_weights(len(control_points), target_curve, new_params.t))
+
         g0 = control_points[target_curve - 1] if target_curve > 0 else control_points[0] * 2 - control_points[1]
         cp0 = control_points[target_curve]
         cp1 = control_points[target_curve + 1] if target_curve + 1 < len(control_points) else control_points[-1]
@@ -42,10 +47,98 @@ def compute_catmull(control_points, params: interpolation_tensor.InterpolationPa
         ip0 = cp0 + (cp1 - g0)/6
         ip1 = cp1 + (cp0 - g1)/6
 
-        new_params = interpolation_tensor.InterpolationParams(math.fmod(params.t * (len(control_points) - 1), 1.), *params[1:])
         return compute_bezier([cp0, ip0, ip1, cp1], new_params)
 
 
+def get_segment(count, t):
+    return min(int(t * (count - 1)), count - 1), math.fmod(t * (count - 1), 1.)
+
+
+def get_segment_table(ts, count):
+    scaled_ts = torch.tensor(ts, dtype=torch.float64) * (count - 1)
+    segments = scaled_ts.to(dtype=torch.int64).clamp(max=count - 1)
+    return list(zip(segments.tolist(), torch.fmod(scaled_ts, 1.).tolist()))
+
+
+def get_bernstein_weights(count, t):
+    degree = count - 1
+    return [math.comb(degree, i) * (1 - t) ** (degree - i) * t ** i for i in range(count)]
+
+
+def get_catmull_weights(count, target_curve, t):
+    b0, b1, b2, b3 = get_bernstein_weights(4, t)
+    i0 = target_curve
+    i1 = min(target_curve + 1, count - 1)
+    weights = [0.] * count
+    weights[i0] += b0 + b1 + b2 / 6
+    weights[i1] += b3 + b2 + b1 / 6
+
+    if target_curve > 0:
+        weights[target_curve - 1] -= b1 / 6
+    else:
+        weights[0] -= b1 / 6 * 2
+        weights[1] += b1 / 6
+
+    if target_curve + 2 < count:
+        weights[target_curve + 2] -= b2 / 6
+    else:
+        weights[i1] -= b2 / 6 * 2
+        weights[i0] += b2 / 6
+
+    return weights
+
+
+def compute_weighted_sum(control_points, weights):
+    total = None
+    for control_point, weight in zip(control_points, weights):
+        if weight == 0:
+            continue
+
+        if total is None:
+            total = control_point * weight
+        else:
+            total = total + control_point * weight
+
+    return total
+
+
+def get_linear_active_control_points(count, params: interpolation_tensor.InterpolationParams, segment=None):
+    if count <= 2:
+        if params.t <= 0:
+            return range(0, 1)
+        if params.t >= 1:
+            return range(count - 1, count)
+        return range(count)
+
+    target_curve, local_t = segment if segment is not None else get_segment(count, params.t)
+    if local_t == 0:
+        return range(target_curve, target_curve + 1)
+
+    return range(target_curve, min(target_curve + 2, count))
+
+
+def get_bezier_active_control_points(count, params: interpolation_tensor.InterpolationParams, _segment=None):
+    if count <= 2:
+        return get_linear_active_control_points(count, params)
+    if params.t <= 0:
+        return range(0, 1)
+    if params.t >= 1:
+        return range(count - 1, count)
+
+    return range(count)
+
+
+def get_catmull_active_control_points(count, params: interpolation_tensor.InterpolationParams, segment=None):
+    if count <= 2:
+        return get_linear_active_control_points(count, params)
+
+    target_curve, local_t = segment if segment is not None else get_segment(count, params.t)
+    if local_t == 0:
+        return range(target_curve, target_curve + 1)
+
+    return range(max(target_curve - 1, 0), min(target_curve + 3, count))
+
+
 if __name__ == '__main__':
     import turtle as tr
     import torch
@@ -1,7 +1,8 @@
 import dataclasses
 import torch
+from lib_prompt_fusion import prompt_limits
 from modules import prompt_parser
-from typing import NamedTuple, Union
+from typing import NamedTuple, Optional, Union
 
 
 class InterpolationParams(NamedTuple):
@@ -27,24 +28,143 @@ class InterpolationTensor:
         if self.__interpolation_function is None:
             return self.get_cond_point(params.step, origin_cond, empty_cond, params.slerp_scale)
 
-        control_points = [
-            sub_tensor.interpolate_cond_rec(params, origin_cond, empty_cond)
-            for sub_tensor in self.__sub_tensors
-        ]
+        control_points = [None] * len(self.__sub_tensors)
+        for i in get_active_control_points(self.__interpolation_function, len(self.__sub_tensors), params):
+            control_points[i] = self.__sub_tensors[i].interpolate_cond_rec(params, origin_cond, empty_cond)
+        fill_inactive_control_points(control_points)
 
         CondWrapper, control_points_values = conds_to_cp_values(control_points)
         return CondWrapper.from_cp_values(self.__interpolation_function(control_points, params) for control_points in control_points_values)
 
+    def interpolate_linear_combinations(self, params_list, origin_conds, empty_cond):
+        leaf_conds = {}
+        weights = [self.get_cond_weights(params, leaf_conds).weights for params in params_list]
+        weights = torch.tensor([[cond_weights.get(key, 0.) for key in leaf_conds] for cond_weights in weights], dtype=torch.float)
+
+        origin_groups = {}
+        for i, origin_cond in enumerate(origin_conds):
+            origin_groups.setdefault(origin_cond.size(0), []).append(i)
+
+        conds = [None] * len(params_list)
+        for group in origin_groups.values():
+            origin_cond = origin_conds[group[0]]
+            group_leaf_conds = [cond.extend_like(origin_cond, empty_cond) for cond in leaf_conds.values()]
+            CondWrapper = type(group_leaf_conds[0])
+            for i, cond in zip(group, CondWrapper.linear_combinations(group_leaf_conds, weights[group])):
+                conds[i] = cond
+
+        return conds
+
+    def get_cond_weights(self, params: InterpolationParams, leaf_conds):
+        if self.__interpolation_function is None:
+            cond = self.get_schedule_at(params.step).cond
+            leaf_conds.setdefault(id(cond), cond)
+            return LinearCombination({id(cond): 1.})
+
+        control_points = [None] * len(self.__sub_tensors)
+        for i in get_active_control_points(self.__interpolation_function, len(self.__sub_tensors), params):
+            control_points[i] = self.__sub_tensors[i].get_cond_weights(params, leaf_conds)
+        fill_inactive_control_points(control_points)
+
+        return self.__interpolation_function(control_points, params)
+
+    def get_leaf_conds(self, leaf_conds):
+        if self.__interpolation_function is None:
+            for schedule in self.__sub_tensors or ():
+                leaf_conds.setdefault(id(schedule.cond), schedule.cond)
+            return leaf_conds
+
+        for sub_tensor in self.__sub_tensors:
+            sub_tensor.get_leaf_conds(leaf_conds)
+        return leaf_conds
+
+    def get_leaf_schedules(self):
+        if self.__interpolation_function is None:
+            return self.__sub_tensors
+
+        return None
+
+    def get_change_steps(self, params_at_steps):
+        if self.__interpolation_function is None:
+            if self.__sub_tensors is None:
+                return set()
+            return {schedule.end_at_step + 1 for schedule in self.__sub_tensors[:-1]}
+
+        sub_change_steps = [sub_tensor.get_change_steps(params_at_steps) for sub_tensor in self.__sub_tensors]
+        change_steps = set()
+        previous_key = None
+        for params in params_at_steps:
+            key = get_params_key(self.__interpolation_function, params)
+            if params.step > 0 and (key != previous_key or any(
+                params.step in sub_change_steps[i]
+                for i in get_active_control_points(self.__interpolation_function, len(self.__sub_tensors), params)
+            )):
+                change_steps.add(params.step)
+            previous_key = key
+
+        return change_steps
+
     def get_cond_point(self, step, origin_cond, empty_cond, slerp_scale):
+        schedule = self.get_schedule_at(step)
+        res = schedule.cond.extend_like(origin_cond, empty_cond)
+        if slerp_scale != 0:
+            res = res.to(dtype=torch.float) - origin_cond.extend_like(schedule.cond, empty_cond).to(dtype=torch.float)
+        return res
+
+    def get_schedule_at(self, step):
         schedule = None
         for schedule in self.__sub_tensors:
             if schedule.end_at_step >= step:
                 break
 
-        res = schedule.cond.extend_like(origin_cond, empty_cond)
-        if slerp_scale != 0:
-            res = res.to(dtype=torch.float) - origin_cond.extend_like(schedule.cond, empty_cond).to(dtype=torch.float)
-        return res
+        return schedule
+
+
+class LinearCombination:
+    def __init__(self, weights):
+        self.weights = weights
+
+    def __add__(self, that):
+        weights = self.weights.copy()
+        for key, weight in that.weights.items():
+            weights[key] = weights.get(key, 0.) + weight
+        return LinearCombination(weights)
+
+    def __sub__(self, that):
+        return self + that * -1.
+
+    def __mul__(self, factor):
+        return LinearCombination({key: weight * factor for key, weight in self.weights.items()})
+
+    def __truediv__(self, divisor):
+        return LinearCombination({key: weight / divisor for key, weight in self.weights.items()})
+
+
+def get_active_control_points(interpolation_function, count, params: InterpolationParams):
+    try:
+        get_function_active_control_points = interpolation_function.get_active_control_points
+    except AttributeError:
+        return range(count)
+
+    return get_function_active_control_points(count, params)
+
+
+def get_params_key(interpolation_function, params: InterpolationParams):
+    try:
+        get_function_params_key = interpolation_function.get_params_key
+    except AttributeError:
+        return params.t
+
+    return get_function_params_key(params)
+
+
+def fill_inactive_control_points(control_points):
+    nearest = next(cp for cp in control_points if cp is not None)
+    for i, cp in enumerate(control_points):
+        if cp is None:
+            control_points[i] = nearest
+        else:
+            nearest = cp
 
 
 def conds_to_cp_values(conds):
@@ -62,22 +182,25 @@ def conds_to_cp_values(conds):
 class InterpolationTensorBuilder:
     def __init__(self, tensor=None, prompt_database=None, interpolation_functions=None):
         self.__indices_tensor = tensor if tensor is not None else 0
-        self.__prompt_database = prompt_database if prompt_database is not None else ['']
+        self.__prompt_prefixes = prompt_database if prompt_database is not None else ['']
+        self.__prompt_suffix = ''
         self.__interpolation_functions = interpolation_functions if interpolation_functions is not None else []
+        self.__reachable_prompt_indices = {}
 
     def append(self, suffix):
-        for i in range(len(self.__prompt_database)):
-            self.__prompt_database[i] += suffix
+        self.__prompt_suffix = _rope_concat(self.__prompt_suffix, suffix)
 
     def extrude(self, tensor_updaters, interpolation_function):
         extruded_indices_tensor = []
         extruded_prompt_database = []
         extruded_interpolation_functions = []
+        prompt_database = self.__get_prompt_ropes()
+        limits_guard = prompt_limits.get_guard()
 
         for update_tensor in tensor_updaters:
             nested_tensor_builder = InterpolationTensorBuilder(
                 self.__indices_tensor,
-                self.__prompt_database[:],
+                prompt_database,
                 interpolation_functions=[])
 
             update_tensor(nested_tensor_builder)
@@ -85,15 +208,66 @@ class InterpolationTensorBuilder:
             extruded_indices_tensor.append(InterpolationTensorBuilder.__offset_tensor(
                 tensor=nested_tensor_builder.__indices_tensor,
                 offset=len(extruded_prompt_database)))
-            extruded_prompt_database.extend(nested_tensor_builder.__prompt_database)
+            extruded_prompt_database.extend(nested_tensor_builder.__get_prompt_ropes())
+            if limits_guard is not None:
+                limits_guard.check_prompt_database_size(len(extruded_prompt_database))
             extruded_interpolation_functions.append(nested_tensor_builder.__interpolation_functions)
 
         self.__indices_tensor = extruded_indices_tensor
-        self.__prompt_database[:] = extruded_prompt_database
+        self.__prompt_prefixes = extruded_prompt_database
+        self.__prompt_suffix = ''
         self.__interpolation_functions.insert(0, (interpolation_function, extruded_interpolation_functions))
 
     def get_prompt_database(self):
-        return self.__prompt_database
+        return [_rope_to_str(rope) for rope in self.__get_prompt_ropes()]
+
+    def get_prompt(self, index):
+        return _rope_to_str(_rope_concat(self.__prompt_prefixes[index], self.__prompt_suffix))
+
+    def get_prompt_database_size(self):
+        return len(self.__prompt_prefixes)
+
+    def __get_prompt_ropes(self):
+        if self.__prompt_suffix == '':
+            return self.__prompt_prefixes
+
+        return [_rope_concat(prefix, self.__prompt_suffix) for prefix in self.__prompt_prefixes]
+
+    def get_interpolation_tree(self):
+        return InterpolationTensorBuilder.__interpolation_tree(self.__indices_tensor, self.__interpolation_functions)
+
+    @staticmethod
+    def __interpolation_tree(tensor, int_funcs):
+        if type(tensor) is int:
+            return tensor
+
+        int_func, nested_int_funcs = int_funcs[0]
+        return int_func, [
+            InterpolationTensorBuilder.__interpolation_tree(sub_tensor, nested_int_funcs + int_funcs[1:])
+            for sub_tensor, nested_int_funcs in zip(tensor, nested_int_funcs)
+        ]
+
+    def get_reachable_prompt_indices(self, total_steps):
+        if total_steps in self.__reachable_prompt_indices:
+            return self.__reachable_prompt_indices[total_steps]
+
+        reachable_indices = set()
+        for step in range(max(total_steps, 1)):
+            params = InterpolationParams(step / max(total_steps, 1), step, total_steps, 0., 0.)
+            InterpolationTensorBuilder.__collect_active_indices(self.__indices_tensor, self.__interpolation_functions, params, reachable_indices)
+
+        self.__reachable_prompt_indices[total_steps] = reachable_indices
+        return reachable_indices
+
+    @staticmethod
+    def __collect_active_indices(tensor, int_funcs, params, active_indices):
+        if type(tensor) is int:
+            active_indices.add(tensor)
+            return
+
+        int_func, nested_int_funcs = int_funcs[0]
+        for i in get_active_control_points(int_func, len(tensor), params):
+            InterpolationTensorBuilder.__collect_active_indices(tensor[i], nested_int_funcs[i] + int_funcs[1:], params, active_indices)
 
     @staticmethod
     def __offset_tensor(tensor, offset):
@@ -123,14 +297,19 @@ class InterpolationTensorBuilder:
             )
 
     def __resize_uniformly(self, conds, max_cond_size: int, empty_cond):
+        resized_conds = {}
+        for schedules in conds:
+            if schedules is not None and id(schedules) not in resized_conds:
+                resized_conds[id(schedules)] = [
+                    prompt_parser.ScheduledPromptConditioning(
+                        cond=schedule.cond.resize_schedule(max_cond_size, empty_cond),
+                        end_at_step=schedule.end_at_step
+                    )
+                    for schedule in schedules
+                ]
+
         return [
-            [
-                prompt_parser.ScheduledPromptConditioning(
-                    cond=schedule.cond.resize_schedule(max_cond_size, empty_cond),
-                    end_at_step=schedule.end_at_step
-                )
-                for schedule in schedules
-            ]
+            resized_conds[id(schedules)] if schedules is not None else None
             for schedules in conds
         ]
 
@@ -138,12 +317,36 @@ class InterpolationTensorBuilder:
     def __max_cond_size(conds):
         return max(schedule.cond.size(0)
                    for schedules in conds
+                   if schedules is not None
                    for schedule in schedules)
 
 
+def _rope_concat(left, right):
+    if left == '':
+        return right
+    if right == '':
+        return left
+
+    return left, right
+
+
+def _rope_to_str(rope):
+    fragments = []
+    ropes = [rope]
+    while ropes:
+        rope = ropes.pop()
+        if type(rope) is str:
+            fragments.append(rope)
+        else:
+            ropes.extend(reversed(rope))
+
+    return ''.join(fragments)
+
+
 @dataclasses.dataclass
 class DictCondWrapper:
     original_cond: dict
+    resources: Optional[dict] = dataclasses.field(default=None, compare=False, repr=False)
 
     @staticmethod
     def from_cp_values(cp_values):
@@ -157,8 +360,11 @@ class DictCondWrapper:
 
     def extend_like(self, that, empty):
         missing_size = max(0, that.size(0) - self.size(0)) // 77
+        if missing_size == 0:
+            return self
+
         extended = DictCondWrapper(self.original_cond.copy())
-        extended.original_cond['crossattn'] = torch.concatenate([self.original_cond['crossattn']] + [empty.original_cond['crossattn']] * missing_size)
+        extended.original_cond['crossattn'] = torch.concatenate([self.original_cond['crossattn'], empty.repeat_chunks(missing_size)])
         return extended
 
     def resize_schedule(self, target_size, empty_cond):
@@ -167,22 +373,40 @@ class DictCondWrapper:
             return self
 
         resized_cond = self.original_cond.copy()
-        resized_cond['crossattn'] = torch.concatenate([self.original_cond['crossattn']] + [empty_cond.original_cond['crossattn']] * cond_missing_size)
+        resized_cond['crossattn'] = torch.concatenate([self.original_cond['crossattn'], empty_cond.repeat_chunks(cond_missing_size)])
         return DictCondWrapper(resized_cond)
 
+    def repeat_chunks(self, count):
+        return _get_resource(self.resources, ('chunks', count), lambda: self.original_cond['crossattn'].repeat(count, 1))
+
     def to_cp_values(self):
         return list(self.original_cond.values())
 
+    @property
+    def nbytes(self):
+        return sum(v.nelement() * v.element_size() for v in self.original_cond.values())
+
+    @staticmethod
+    def linear_combinations(conds, weights):
+        combined = {
+            k: _linear_combinations([cond.original_cond[k] for cond in conds], weights)
+            for k in conds[0].original_cond.keys()
+        }
+        return [
+            DictCondWrapper({k: v[i] for k, v in combined.items()})
+            for i in range(weights.size(0))
+        ]
+
     def to(self, dtype: Union[dict, torch.dtype]):
         if not isinstance(dtype, dict):
             dtype = {
                 k: dtype
                 for k in self.original_cond.keys()
             }
-        return DictCondWrapper({
+        return _get_resource(self.resources, ('to', tuple(dtype.items())), lambda: DictCondWrapper({
             k: v.to(dtype=dtype[k])
             for k, v in self.original_cond.items()
-        })
+        }, resources=None if self.resources is None else {}))
 
     @property
     def dtype(self):
@@ -210,6 +434,7 @@ class DictCondWrapper:
 @dataclasses.dataclass
 class TensorCondWrapper:
     original_cond: torch.Tensor
+    resources: Optional[dict] = dataclasses.field(default=None, compare=False, repr=False)
 
     @staticmethod
     def from_cp_values(cp_values):
@@ -220,20 +445,39 @@ class TensorCondWrapper:
 
     def extend_like(self, that, empty):
         missing_size = max(0, that.size(0) - self.original_cond.size(0)) // 77
-        return TensorCondWrapper(torch.concatenate([self.original_cond] + [empty.original_cond] * missing_size))
+        if missing_size == 0:
+            return self
+
+        return TensorCondWrapper(torch.concatenate([self.original_cond, empty.repeat_chunks(missing_size)]))
 
     def resize_schedule(self, target_size, empty_cond):
         cond_missing_size = (target_size - self.original_cond.size(0)) // 77
         if cond_missing_size <= 0:
             return self
 
-        return TensorCondWrapper(torch.concatenate([self.original_cond] + [empty_cond.original_cond] * cond_missing_size))
+        return TensorCondWrapper(torch.concatenate([self.original_cond, empty_cond.repeat_chunks(cond_missing_size)]))
+
+    def repeat_chunks(self, count):
+        return _get_resource(self.resources, ('chunks', count), lambda: self.original_cond.repeat(count, 1))
 
     def to_cp_values(self):
         return [self.original_cond]
 
+    @property
+    def nbytes(self):
+        return self.original_cond.nelement() * self.original_cond.element_size()
+
+    @staticmethod
+    def linear_combinations(conds, weights):
+        return [
+            TensorCondWrapper(cond)
+            for cond in _linear_combinations([cond.original_cond for cond in conds], weights)
+        ]
+
     def to(self, dtype: torch.dtype):
-        return TensorCondWrapper(self.original_cond.to(dtype=dtype))
+        return _get_resource(self.resources, ('to', dtype), lambda: TensorCondWrapper(
+            self.original_cond.to(dtype=dtype),
+            resources=None if self.resources is None else {}))
 
     @property
     def dtype(self):
@@ -247,3 +491,19 @@ class TensorCondWrapper:
 
     def __eq__(self, that):
         return (self.original_cond == that.original_cond).all()
+
+
+def _get_resource(resources, key, create):
+    if resources is None:
+        return create()
+
+    resource = resources.get(key)
+    if resource is None:
+        resource = resources[key] = create()
+    return resource
+
+
+def _linear_combinations(tensors, weights):
+    stacked = torch.stack(tensors)
+    weights = weights.to(device=stacked.device)
+    return torch.tensordot(weights, stacked.to(dtype=weights.dtype), dims=1).to(dtype=stacked.dtype)
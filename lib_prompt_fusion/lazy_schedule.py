@@ -0,0 +1,112 @@
+from lib_prompt_fusion import global_state, lru_cache
+from modules import prompt_parser
+
+
+max_batched_intervals = 8
+
+
+class LazyConditioningSchedule:
+    def __init__(self, tensor, intervals, params_at_steps, origin_schedules, empty_cond, cache_size=2):
+        self.__tensor = tensor
+        self.__intervals = intervals
+        self.__params_at_steps = params_at_steps
+        self.__origin_schedules = origin_schedules
+        self.__empty_cond = empty_cond
+        self.__cache_size = cache_size
+        self.__conds = lru_cache.LruCache(max_entries=cache_size)
+        self.__is_batched = len(intervals) <= max_batched_intervals and all(params.slerp_scale == 0 for params in params_at_steps)
+        self.__batched_conds = None
+
+    def get_nbytes(self):
+        leaf_conds = self.__tensor.get_leaf_conds({}).values()
+        max_cond_nbytes = max((cond.nbytes for cond in leaf_conds), default=0)
+        return sum(cond.nbytes for cond in leaf_conds) + max_cond_nbytes * len(self.__intervals)
+
+    def retain_conds(self):
+        self.__conds.resize(max_entries=None)
+        if all(params.slerp_scale == 0 for params in self.__params_at_steps):
+            self.__is_batched = True
+
+    def get_cond(self, index):
+        if self.__is_batched:
+            if self.__batched_conds is None:
+                self.__batched_conds = self.__interpolate_all()
+            return self.__batched_conds[index]
+
+        return self.__conds.get_or_create(index, lambda: self.__interpolate(index))
+
+    def get_schedules(self, unwrap=False):
+        return [
+            LazyScheduledPromptConditioning(self, index, end_step - 1, unwrap)
+            for index, (_, end_step) in enumerate(self.__intervals)
+        ]
+
+    def __interpolate(self, index):
+        begin_step, end_step = self.__intervals[index]
+        params = self.__params_at_steps[begin_step]
+        origin_cond = global_state.get_schedule_cond_at(self.__origin_schedules, begin_step, self.__empty_cond)
+        with global_state.phase_recorder.phase('interpolate', steps=end_step - begin_step):
+            if params.slerp_scale == 0:
+                return self.__tensor.interpolate_linear_combinations([params], [origin_cond], self.__empty_cond)[0]
+
+            return self.__tensor.interpolate(params, origin_cond, self.__empty_cond)
+
+    def __interpolate_all(self):
+        params_list = [self.__params_at_steps[begin_step] for begin_step, _ in self.__intervals]
+        origin_conds = [
+            global_state.get_schedule_cond_at(self.__origin_schedules, begin_step, self.__empty_cond)
+            for begin_step, _ in self.__intervals
+        ]
+        with global_state.phase_recorder.phase('interpolate', steps=len(self.__params_at_steps), intervals=len(self.__intervals)):
+            return self.__tensor.interpolate_linear_combinations(params_list, origin_conds, self.__empty_cond)
+
+
+class LazyScheduledPromptConditioning(prompt_parser.ScheduledPromptConditioning):
+    def __new__(cls, schedule, index, end_at_step, unwrap):
+        self = super().__new__(cls, end_at_step=end_at_step, cond=None)
+        self.__schedule = schedule
+        self.__index = index
+        self.__unwrap = unwrap
+        return self
+
+    @property
+    def cond(self):
+        cond = self.__schedule.get_cond(self.__index)
+        return cond.original_cond if self.__unwrap else cond
+
+    def __iter__(self):
+        yield self.end_at_step
+        yield self.cond
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __repr__(self):
+        return repr(prompt_parser.ScheduledPromptConditioning(*self))
+
+    def __reduce__(self):
+        return prompt_parser.ScheduledPromptConditioning, tuple(self)
+
+    def _replace(self, **kwargs):
+        return prompt_parser.ScheduledPromptConditioning(*self)._replace(**kwargs)
+
+
+class StaticConditioningSchedule:
+    def __init__(self, schedules):
+        self.__schedules = schedules
+
+    def get_nbytes(self):
+        conds = {id(schedule.cond): schedule.cond for schedule in self.__schedules}
+        return sum(cond.nbytes for cond in conds.values())
+
+    def retain_conds(self):
+        pass
+
+    def get_schedules(self, unwrap=False):
+        if not unwrap:
+            return list(self.__schedules)
+
+        return [
+            prompt_parser.ScheduledPromptConditioning(cond=schedule.cond.original_cond, end_at_step=schedule.end_at_step)
+            for schedule in self.__schedules
+        ]
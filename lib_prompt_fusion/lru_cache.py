@@ -0,0 +1,98 @@
+import collections
+import threading
+
+
+_unchanged = object()
+
+
+class LruCache:
+    def __init__(self, max_entries=None, max_bytes=None, size_of=None):
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__size_of = size_of if size_of is not None else lambda _key, _value: 0
+        self.__total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value, _ = self.__entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.__size_of(key, value)
+        with self.__lock:
+            if key in self.__entries:
+                self.__total_bytes -= self.__entries.pop(key)[1]
+
+            if not self.__fits(size):
+                return value
+
+            self.__entries[key] = value, size
+            self.__total_bytes += size
+            self.__evict()
+            return value
+
+    def get_or_create(self, key, create):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = self.put(key, create())
+
+        return value
+
+    def resize(self, max_entries=_unchanged, max_bytes=_unchanged):
+        with self.__lock:
+            if max_entries is not _unchanged:
+                self.__max_entries = max_entries
+            if max_bytes is not _unchanged:
+                self.__max_bytes = max_bytes
+            self.__evict()
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__total_bytes = 0
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'entries': len(self.__entries),
+                'bytes': self.__total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __fits(self, size):
+        if self.__max_entries is not None and self.__max_entries <= 0:
+            return False
+        if self.__max_bytes is not None and self.__max_bytes <= 0:
+            return False
+
+        return self.__max_bytes is None or size <= self.__max_bytes
+
+    def __evict(self):
+        while self.__entries and (
+            self.__max_entries is not None and len(self.__entries) > self.__max_entries or
+            self.__max_bytes is not None and self.__total_bytes > self.__max_bytes
+        ):
+            _, (_, size) = self.__entries.popitem(last=False)
+            self.__total_bytes -= size
+            self.evictions += 1
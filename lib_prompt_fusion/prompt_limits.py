@@ -0,0 +1,89 @@
+import contextlib
+import contextvars
+import sys
+import time
+from typing import NamedTuple
+
+
+class PromptLimits(NamedTuple):
+    max_ast_depth: int = 0
+    max_substitution_depth: int = 0
+    max_prompt_database_size: int = 0
+    max_expanded_characters: int = 0
+    max_compile_seconds: float = 0.
+
+
+class PromptLimitError(ValueError):
+    def __init__(self, limit, value, maximum):
+        details = f' ({value} > {maximum})' if value is not None else f' ({maximum})'
+        super().__init__(f'prompt exceeds the {limit} limit{details}')
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+
+    def to_dict(self):
+        return {
+            'error': type(self).__name__,
+            'limit': self.limit,
+            'value': self.value,
+            'maximum': self.maximum,
+            'message': str(self),
+        }
+
+
+class LimitsGuard:
+    def __init__(self, limits: PromptLimits):
+        self.limits = limits
+        self.__start = time.monotonic()
+
+    def check_ast_depth(self, depth):
+        _check('max_ast_depth', depth, self.limits.max_ast_depth)
+        self.check_deadline()
+
+    def check_substitution_depth(self, depth):
+        _check('max_substitution_depth', depth, self.limits.max_substitution_depth)
+
+    def check_deadline(self):
+        if self.limits.max_compile_seconds > 0:
+            _check('max_compile_seconds', round(time.monotonic() - self.__start, 3), self.limits.max_compile_seconds)
+
+    def check_prompt_database_size(self, size):
+        _check('max_prompt_database_size', size, self.limits.max_prompt_database_size)
+        self.check_deadline()
+
+    def check_plan(self, plan):
+        _check('max_ast_depth', plan.metrics.ast_depth, self.limits.max_ast_depth)
+        _check('max_substitution_depth', plan.metrics.substitution_depth, self.limits.max_substitution_depth)
+        if self.limits.max_compile_seconds > 0:
+            _check('max_compile_seconds', round(plan.metrics.compile_seconds, 3), self.limits.max_compile_seconds)
+        self.check_deadline()
+
+    def check_tensor_builder(self, tensor_builder):
+        self.check_prompt_database_size(tensor_builder.get_prompt_database_size())
+        if self.limits.max_expanded_characters > 0:
+            characters = sum(len(prompt) for prompt in tensor_builder.get_prompt_database())
+            _check('max_expanded_characters', characters, self.limits.max_expanded_characters)
+
+
+_current_guard = contextvars.ContextVar('prompt_fusion_limits_guard', default=None)
+
+
+def get_guard():
+    return _current_guard.get()
+
+
+@contextlib.contextmanager
+def enforce(limits: PromptLimits):
+    guard = LimitsGuard(limits)
+    token = _current_guard.set(guard)
+    try:
+        yield guard
+    except RecursionError:
+        raise PromptLimitError('recursion_depth', None, sys.getrecursionlimit()) from None
+    finally:
+        _current_guard.reset(token)
+
+
+def _check(limit, value, maximum):
+    if 0 < maximum < value:
+        raise PromptLimitError(limit, value, maximum)
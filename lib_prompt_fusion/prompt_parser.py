@@ -1,378 +1,457 @@
 import lib_prompt_fusion.ast_nodes as ast
 from collections import namedtuple
+import functools
 import re
 
 
-ParseResult = namedtuple('ParseResult', ['prompt', 'expr'])
+ParseResult = namedtuple('ParseResult', ['pos', 'expr'])
+
+
+class ParseState:
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.memo = {}
+
+    def peek(self, pos):
+        return self.prompt[pos:pos + 1]
 
 
 def parse_prompt(prompt):
-    prompt = prompt.lstrip()
-    prompt, list_expr = parse_list_expression(prompt, set())
+    state = ParseState(prompt.lstrip())
+    _, list_expr = parse_list_expression(state, 0, frozenset())
     return list_expr
 
 
-def parse_list_expression(prompt, stoppers):
+def is_plain_prompt(prompt):
+    return _FUSION_SYNTAX.search(prompt) is None
+
+
+def parse_list_expression(state, pos, stoppers):
+    memo_key = (parse_list_expression, pos, stoppers)
+    if memo_key in state.memo:
+        return state.memo[memo_key]
+
     exprs = []
-    try:
-        while True:
-            prompt, expr = parse_expression(prompt, stoppers)
-            exprs.append(expr)
-    except ValueError:
-        return ParseResult(prompt=prompt, expr=ast.ListExpression(exprs))
+    while True:
+        result = parse_expression(state, pos, stoppers)
+        if result is None:
+            break
 
+        pos, expr = result
+        exprs.append(expr)
 
-def parse_expression(prompt, stoppers):
-    for parse in _parsers():
-        try:
-            return parse(prompt, stoppers)
-        except ValueError:
-            pass
+    result = state.memo[memo_key] = ParseResult(pos=pos, expr=ast.ListExpression(exprs))
+    return result
 
-    raise ValueError
 
+def parse_expression(state, pos, stoppers):
+    memo_key = (parse_expression, pos, stoppers)
+    if memo_key in state.memo:
+        return state.memo[memo_key]
 
-def _parsers():
-    return (
-        parse_text,
-        parse_declaration,
-        parse_substitution,
-        parse_positive_attention,
-        parse_negative_attention,
-        parse_editing,
-        parse_alternation,
-        parse_interpolation,
-        parse_unrestricted_text,
-    )
+    result = parse_text(state, pos, stoppers)
+    if result is None:
+        for parse in _DISPATCH_PARSERS.get(state.peek(pos), ()):
+            result = parse(state, pos, stoppers)
+            if result is not None:
+                break
+        else:
+            result = parse_unrestricted_text(state, pos, stoppers)
 
+    state.memo[memo_key] = result
+    return result
 
-def parse_text(prompt, stoppers):
-    return parse_unrestricted_text(prompt, set_concat(stoppers, {'[', '(', '$'}))
 
+def parse_text(state, pos, stoppers):
+    return parse_unrestricted_text(state, pos, stoppers | _TEXT_STOPPERS)
 
-def parse_unrestricted_text(prompt, stoppers):
-    escaped_stoppers = ''.join(re.escape(stopper) for stopper in stoppers)
-    regex = rf'(?:[^{escaped_stoppers}\\\s]|\$(?![a-zA-Z_])|\\.)+'
-    prompt, expr = parse_token(prompt, whitespace_tail_regex(regex, stoppers))
-    return ParseResult(prompt=prompt, expr=ast.LiftExpression(expr))
 
+def parse_unrestricted_text(state, pos, stoppers):
+    result = parse_token(state, pos, _text_token(stoppers), stoppers)
+    if result is None:
+        return None
 
-def parse_substitution(prompt, stoppers):
-    prompt, symbol = parse_symbol(prompt, stoppers)
-    prompt, arguments = parse_arguments(prompt, stoppers)
-    return ParseResult(prompt=prompt, expr=ast.SubstitutionExpression(symbol, arguments))
+    return ParseResult(pos=result.pos, expr=ast.LiftExpression(result.expr))
 
 
-def parse_arguments(prompt, stoppers):
-    try:
-        prompt, _ = parse_open_paren(prompt, stoppers)
-        prompt, arguments = parse_inner_arguments(prompt, stoppers)
-        prompt, _ = parse_close_paren(prompt, stoppers)
-    except ValueError:
-        arguments = []
-    return ParseResult(prompt=prompt, expr=arguments)
+def parse_substitution(state, pos, stoppers):
+    result = parse_symbol(state, pos, stoppers)
+    if result is None:
+        return None
 
+    pos, symbol = result
+    pos, arguments = parse_arguments(state, pos, stoppers)
+    return ParseResult(pos=pos, expr=ast.SubstitutionExpression(symbol, arguments))
 
-def parse_inner_arguments(prompt, stoppers):
-    arguments = []
-    try:
-        while True:
-            prompt, arg = parse_list_expression(prompt, {',', ')'})
-            arguments.append(arg)
-            prompt, _ = parse_comma(prompt, stoppers)
-    except ValueError:
-        pass
 
-    return ParseResult(prompt=prompt, expr=arguments)
+def parse_arguments(state, pos, stoppers):
+    result = parse_token(state, pos, _OPEN_PAREN, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=[])
 
+    pos, arguments = parse_inner_arguments(state, result.pos, stoppers)
+    result = parse_token(state, pos, _CLOSE_PAREN, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=[])
 
-def parse_declaration(prompt, stoppers):
-    prompt, symbol = parse_symbol(prompt, stoppers)
-    prompt, parameters = parse_parameters(prompt, stoppers)
-    prompt, _ = parse_equals(prompt, stoppers)
-    prompt, value = parse_list_expression(prompt, set_concat(stoppers, '\n'))
-    prompt, _ = parse_newline(prompt, stoppers)
-    prompt, expr = parse_list_expression(prompt, stoppers)
-    return ParseResult(prompt=prompt, expr=ast.DeclarationExpression(symbol, parameters, value, expr))
+    return ParseResult(pos=result.pos, expr=arguments)
 
 
-def parse_parameters(prompt, stoppers):
-    try:
-        prompt, _ = parse_open_paren(prompt, stoppers)
-        prompt, parameters = parse_inner_parameters(prompt, stoppers)
-        prompt, _ = parse_close_paren(prompt, stoppers)
-    except ValueError:
-        parameters = []
-    return ParseResult(prompt=prompt, expr=parameters)
+def parse_inner_arguments(state, pos, stoppers):
+    arguments = []
+    while True:
+        pos, arg = parse_list_expression(state, pos, _ARGUMENT_STOPPERS)
+        arguments.append(arg)
+        result = parse_token(state, pos, _COMMA, stoppers)
+        if result is None:
+            return ParseResult(pos=pos, expr=arguments)
 
+        pos = result.pos
 
-def parse_inner_parameters(prompt, stoppers):
-    parameters = []
-    try:
-        while True:
-            prompt, param = parse_symbol(prompt, stoppers)
-            parameters.append(param)
-            prompt, _ = parse_comma(prompt, stoppers)
-    except ValueError:
-        pass
 
-    return ParseResult(prompt=prompt, expr=parameters)
+def parse_declaration(state, pos, stoppers):
+    result = parse_symbol(state, pos, stoppers)
+    if result is None:
+        return None
 
+    pos, symbol = result
+    pos, parameters = parse_parameters(state, pos, stoppers)
+    result = parse_token(state, pos, _EQUALS, stoppers)
+    if result is None:
+        return None
 
-def parse_interpolation(prompt, stoppers):
-    prompt, _ = parse_open_square(prompt, stoppers)
-    prompt, exprs = parse_interpolation_exprs(prompt, stoppers)
-    prompt, steps = parse_interpolation_steps(prompt, stoppers)
-    prompt, function_name = parse_interpolation_function_name(prompt, stoppers)
-    prompt, _ = parse_close_square(prompt, stoppers)
-    return ParseResult(prompt=prompt, expr=ast.InterpolationExpression.create(exprs, steps, function_name))
+    pos, value = parse_list_expression(state, result.pos, stoppers | _NEWLINE_STOPPERS)
+    result = parse_token(state, pos, _NEWLINE, stoppers)
+    if result is None:
+        return None
 
+    pos, expr = parse_list_expression(state, result.pos, stoppers)
+    return ParseResult(pos=pos, expr=ast.DeclarationExpression(symbol, parameters, value, expr))
 
-def parse_interpolation_exprs(prompt, stoppers):
-    exprs = []
 
-    try:
-        while True:
-            prompt_tmp, expr = parse_list_expression(prompt, {':', ']'})
-            if parse_interpolation_function_name(prompt_tmp, stoppers).expr is not None:
-                raise ValueError
+def parse_parameters(state, pos, stoppers):
+    result = parse_token(state, pos, _OPEN_PAREN, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=[])
 
-            prompt, _ = parse_colon(prompt_tmp, stoppers)
-            exprs.append(expr)
-    except ValueError:
-        pass
+    pos, parameters = parse_inner_parameters(state, result.pos, stoppers)
+    result = parse_token(state, pos, _CLOSE_PAREN, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=[])
 
-    return ParseResult(prompt=prompt, expr=exprs)
+    return ParseResult(pos=result.pos, expr=parameters)
 
 
-def parse_interpolation_function_name(prompt, stoppers):
-    try:
-        prompt, _ = parse_colon(prompt, stoppers)
-        function_names = ('linear', 'catmull', 'bezier', 'mean')
-        return parse_token(prompt, whitespace_tail_regex('|'.join(function_names), stoppers))
-    except ValueError:
-        return ParseResult(prompt=prompt, expr=None)
+def parse_inner_parameters(state, pos, stoppers):
+    parameters = []
+    while True:
+        result = parse_symbol(state, pos, stoppers)
+        if result is None:
+            return ParseResult(pos=pos, expr=parameters)
 
+        pos, param = result
+        parameters.append(param)
+        result = parse_token(state, pos, _COMMA, stoppers)
+        if result is None:
+            return ParseResult(pos=pos, expr=parameters)
 
-def parse_interpolation_steps(prompt, stoppers):
-    steps = []
+        pos = result.pos
 
-    try:
-        while True:
-            prompt, step = parse_interpolation_step(prompt, stoppers)
-            steps.append(step)
-            prompt, _ = parse_comma(prompt, stoppers)
-    except ValueError:
-        pass
 
-    return ParseResult(prompt=prompt, expr=steps)
+def parse_interpolation(state, pos, stoppers):
+    result = parse_token(state, pos, _OPEN_SQUARE, stoppers)
+    if result is None:
+        return None
 
+    pos, exprs = parse_interpolation_exprs(state, result.pos, stoppers)
+    pos, steps = parse_interpolation_steps(state, pos, stoppers)
+    pos, function_name = parse_interpolation_function_name(state, pos, stoppers)
+    result = parse_token(state, pos, _CLOSE_SQUARE, stoppers)
+    if result is None:
+        return None
 
-def parse_interpolation_step(prompt, stoppers):
     try:
-        return parse_step(prompt, stoppers)
+        expr = ast.InterpolationExpression.create(exprs, steps, function_name)
     except ValueError:
-        pass
+        return None
 
-    if prompt[0] in {',', ':', ']'}:
-        return ParseResult(prompt=prompt, expr=None)
+    return ParseResult(pos=result.pos, expr=expr)
 
-    raise ValueError
 
+def parse_interpolation_exprs(state, pos, stoppers):
+    exprs = []
 
-def parse_alternation(prompt, stoppers):
-    prompt, _ = parse_open_square(prompt, stoppers)
-    prompt, exprs = parse_alternation_exprs(prompt, stoppers)
-    prompt, speed = parse_alternation_speed(prompt, stoppers)
-    prompt, _ = parse_close_square(prompt, stoppers)
-    return ParseResult(prompt=prompt, expr=ast.AlternationExpression(exprs, speed))
+    while True:
+        pos_tmp, expr = parse_list_expression(state, pos, _INTERPOLATION_STOPPERS)
+        if parse_interpolation_function_name(state, pos_tmp, stoppers).expr is not None:
+            break
 
+        result = parse_token(state, pos_tmp, _COLON, stoppers)
+        if result is None:
+            break
 
-def parse_alternation_exprs(prompt, stoppers):
-    exprs = []
+        pos = result.pos
+        exprs.append(expr)
 
-    try:
-        while True:
-            prompt, expr = parse_list_expression(prompt, {'|', ':', ']'})
-            exprs.append(expr)
-            prompt, _ = parse_vertical_bar(prompt, stoppers)
-    except ValueError:
-        if len(exprs) < 2:
-            raise
+    return ParseResult(pos=pos, expr=exprs)
 
-    return ParseResult(prompt=prompt, expr=exprs)
 
+def parse_interpolation_function_name(state, pos, stoppers):
+    result = parse_token(state, pos, _COLON, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=None)
 
-def parse_alternation_speed(prompt, stoppers):
-    try:
-        prompt, _ = parse_colon(prompt, stoppers)
-        prompt, speed = parse_step(prompt, stoppers)
-        return ParseResult(prompt=prompt, expr=speed)
-    except ValueError:
-        pass
+    pos = result.pos
+    result = parse_token(state, pos, _FUNCTION_NAME, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=None)
 
-    return ParseResult(prompt=prompt, expr=None)
+    return result
 
 
-def parse_editing(prompt, stoppers):
-    prompt, _ = parse_open_square(prompt, stoppers)
-    prompt, exprs = parse_editing_exprs(prompt, stoppers)
-    try:
-        prompt, step = parse_step(prompt, stoppers)
-    except ValueError:
-        step = None
+def parse_interpolation_steps(state, pos, stoppers):
+    steps = []
 
-    prompt, _ = parse_close_square(prompt, stoppers)
-    return ParseResult(prompt=prompt, expr=ast.EditingExpression(exprs, step))
+    while True:
+        result = parse_interpolation_step(state, pos, stoppers)
+        if result is None:
+            break
 
+        pos, step = result
+        steps.append(step)
+        result = parse_token(state, pos, _COMMA, stoppers)
+        if result is None:
+            break
 
-def parse_editing_exprs(prompt, stoppers):
-    exprs = []
+        pos = result.pos
 
-    try:
-        for _ in range(2):
-            prompt_tmp, expr = parse_list_expression(prompt, {'|', ':', ']'})
-            prompt, _ = parse_colon(prompt_tmp, stoppers)
-            exprs.append(expr)
-    except ValueError:
-        pass
+    return ParseResult(pos=pos, expr=steps)
 
-    return ParseResult(prompt=prompt, expr=exprs)
 
+def parse_interpolation_step(state, pos, stoppers):
+    result = parse_step(state, pos, stoppers)
+    if result is not None:
+        return result
 
-def parse_negative_attention(prompt, stoppers):
-    prompt, _ = parse_open_square(prompt, stoppers)
-    prompt, expr = parse_list_expression(prompt, set_concat(stoppers, {':', ']'}))
-    prompt, _ = parse_close_square(prompt, stoppers)
-    return ParseResult(prompt=prompt, expr=ast.WeightedExpression(expr, positive=False))
+    if state.peek(pos) in _EMPTY_STEP_FOLLOWERS:
+        return ParseResult(pos=pos, expr=None)
 
+    return None
 
-def parse_positive_attention(prompt, stoppers):
-    prompt, _ = parse_open_paren(prompt, stoppers)
-    prompt, expr = parse_list_expression(prompt, {':', ')'})
-    prompt, weight_exprs = parse_attention_weights(prompt, stoppers)
-    prompt, _ = parse_close_paren(prompt, stoppers)
-    if len(weight_exprs) >= 2:
-        return ParseResult(prompt=prompt, expr=ast.WeightInterpolationExpression(expr, *weight_exprs[:2]))
-    else:
-        return ParseResult(prompt=prompt, expr=ast.WeightedExpression(expr, *weight_exprs[:1]))
 
+def parse_alternation(state, pos, stoppers):
+    result = parse_token(state, pos, _OPEN_SQUARE, stoppers)
+    if result is not None:
+        result = parse_alternation_exprs(state, result.pos, stoppers)
+    if result is None:
+        return None
 
-def parse_attention_weights(prompt, stoppers):
-    weights = []
-    try:
-        prompt, _ = parse_colon(prompt, stoppers)
-    except ValueError:
-        return ParseResult(prompt=prompt, expr=weights)
+    pos, exprs = result
+    pos, speed = parse_alternation_speed(state, pos, stoppers)
+    result = parse_token(state, pos, _CLOSE_SQUARE, stoppers)
+    if result is None:
+        return None
+
+    return ParseResult(pos=result.pos, expr=ast.AlternationExpression(exprs, speed))
+
+
+def parse_alternation_exprs(state, pos, stoppers):
+    exprs = []
 
     while True:
-        try:
-            prompt, weight_expr = parse_weight(prompt, stoppers)
-            weights.append(weight_expr)
-            prompt, _ = parse_comma(prompt, stoppers)
-        except ValueError:
-            return ParseResult(prompt=prompt, expr=weights)
+        pos, expr = parse_list_expression(state, pos, _ALTERNATION_STOPPERS)
+        exprs.append(expr)
+        result = parse_token(state, pos, _VERTICAL_BAR, stoppers)
+        if result is None:
+            break
 
+        pos = result.pos
 
-def parse_step(prompt, stoppers):
-    try:
-        prompt, step = parse_int_not_float(prompt, stoppers)
-        return ParseResult(prompt=prompt, expr=ast.LiftExpression(step))
-    except ValueError:
-        pass
-    try:
-        prompt, step = parse_float(prompt, stoppers)
-        return ParseResult(prompt=prompt, expr=ast.LiftExpression(step))
-    except ValueError:
-        pass
+    if len(exprs) < 2:
+        return None
 
-    return parse_substitution(prompt, stoppers)
+    return ParseResult(pos=pos, expr=exprs)
 
 
-def parse_weight(prompt, stoppers):
-    try:
-        prompt, step = parse_float(prompt, stoppers)
-        return ParseResult(prompt=prompt, expr=ast.LiftExpression(step))
-    except ValueError:
-        pass
+def parse_alternation_speed(state, pos, stoppers):
+    result = parse_token(state, pos, _COLON, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=None)
 
-    return parse_substitution(prompt, stoppers)
+    pos = result.pos
+    result = parse_step(state, pos, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=None)
+
+    return result
 
 
-def parse_symbol(prompt, stoppers):
-    prompt, _ = parse_dollar(prompt)
-    return parse_symbol_text(prompt, stoppers)
+def parse_editing(state, pos, stoppers):
+    result = parse_token(state, pos, _OPEN_SQUARE, stoppers)
+    if result is None:
+        return None
 
+    pos, exprs = parse_editing_exprs(state, result.pos, stoppers)
+    result = parse_step(state, pos, stoppers)
+    if result is None:
+        step = None
+    else:
+        pos, step = result
 
-def parse_symbol_text(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex('[a-zA-Z_][a-zA-Z0-9_]*', stoppers))
+    result = parse_token(state, pos, _CLOSE_SQUARE, stoppers)
+    if result is None:
+        return None
 
+    return ParseResult(pos=result.pos, expr=ast.EditingExpression(exprs, step))
 
-def parse_float(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(r'[+-]?(?:\d+(?:\.\d*)?|\.\d+)', stoppers))
 
+def parse_editing_exprs(state, pos, stoppers):
+    exprs = []
 
-def parse_int_not_float(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(r'[+-]?\d+(?!\.)', stoppers))
+    for _ in range(2):
+        pos_tmp, expr = parse_list_expression(state, pos, _ALTERNATION_STOPPERS)
+        result = parse_token(state, pos_tmp, _COLON, stoppers)
+        if result is None:
+            break
 
+        pos = result.pos
+        exprs.append(expr)
 
-def parse_dollar(prompt):
-    dollar_sign = re.escape('$')
-    return parse_token(prompt, f'({dollar_sign})')
+    return ParseResult(pos=pos, expr=exprs)
 
 
-def parse_equals(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(re.escape('='), stoppers))
+def parse_negative_attention(state, pos, stoppers):
+    result = parse_token(state, pos, _OPEN_SQUARE, stoppers)
+    if result is None:
+        return None
 
+    pos, expr = parse_list_expression(state, result.pos, stoppers | _INTERPOLATION_STOPPERS)
+    result = parse_token(state, pos, _CLOSE_SQUARE, stoppers)
+    if result is None:
+        return None
 
-def parse_comma(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(re.escape(','), stoppers))
+    return ParseResult(pos=result.pos, expr=ast.WeightedExpression(expr, positive=False))
 
 
-def parse_colon(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(re.escape(':'), stoppers))
+def parse_positive_attention(state, pos, stoppers):
+    result = parse_token(state, pos, _OPEN_PAREN, stoppers)
+    if result is None:
+        return None
 
+    pos, expr = parse_list_expression(state, result.pos, _POSITIVE_ATTENTION_STOPPERS)
+    pos, weight_exprs = parse_attention_weights(state, pos, stoppers)
+    result = parse_token(state, pos, _CLOSE_PAREN, stoppers)
+    if result is None:
+        return None
 
-def parse_vertical_bar(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(re.escape('|'), stoppers))
+    if len(weight_exprs) >= 2:
+        return ParseResult(pos=result.pos, expr=ast.WeightInterpolationExpression(expr, *weight_exprs[:2]))
+    else:
+        return ParseResult(pos=result.pos, expr=ast.WeightedExpression(expr, *weight_exprs[:1]))
 
 
-def parse_open_square(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(re.escape('['), stoppers))
+def parse_attention_weights(state, pos, stoppers):
+    weights = []
+    result = parse_token(state, pos, _COLON, stoppers)
+    if result is None:
+        return ParseResult(pos=pos, expr=weights)
 
+    pos = result.pos
+    while True:
+        result = parse_weight(state, pos, stoppers)
+        if result is None:
+            return ParseResult(pos=pos, expr=weights)
 
-def parse_close_square(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(re.escape(']'), stoppers))
+        pos, weight_expr = result
+        weights.append(weight_expr)
+        result = parse_token(state, pos, _COMMA, stoppers)
+        if result is None:
+            return ParseResult(pos=pos, expr=weights)
 
+        pos = result.pos
 
-def parse_open_paren(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(re.escape('('), stoppers))
 
+def parse_step(state, pos, stoppers):
+    result = parse_token(state, pos, _INT_NOT_FLOAT, stoppers)
+    if result is None:
+        result = parse_token(state, pos, _FLOAT, stoppers)
+    if result is not None:
+        return ParseResult(pos=result.pos, expr=ast.LiftExpression(result.expr))
 
-def parse_close_paren(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex(re.escape(')'), stoppers))
+    return parse_substitution(state, pos, stoppers)
 
 
-def parse_newline(prompt, stoppers):
-    return parse_token(prompt, whitespace_tail_regex('\n|$', stoppers))
+def parse_weight(state, pos, stoppers):
+    result = parse_token(state, pos, _FLOAT, stoppers)
+    if result is not None:
+        return ParseResult(pos=result.pos, expr=ast.LiftExpression(result.expr))
 
+    return parse_substitution(state, pos, stoppers)
 
-def parse_token(prompt, regex):
-    match = re.match(regex, prompt)
-    if match is None:
-        raise ValueError
 
-    return ParseResult(prompt=prompt[len(match.group()):], expr=match.groups()[-1])
+def parse_symbol(state, pos, stoppers):
+    if state.peek(pos) != '$':
+        return None
 
+    return parse_token(state, pos + 1, _SYMBOL, stoppers)
 
-def whitespace_tail_regex(regex, stoppers):
-    if '\n' in stoppers:
-        return rf'({regex})[ \t\f\r]*'
 
-    return rf'({regex})\s*'
+def parse_token(state, pos, token, stoppers):
+    match = token[1 if '\n' in stoppers else 0].match(state.prompt, pos)
+    if match is None:
+        return None
 
+    return ParseResult(pos=match.end(), expr=match.group(1))
 
-def set_concat(left, right):
-    result = set(left)
-    result.update(right)
-    return result
+
+def whitespace_tail_regex(regex):
+    return (
+        re.compile(rf'({regex})\s*'),
+        re.compile(rf'({regex})[ \t\f\r]*'),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _text_token(stoppers):
+    escaped_stoppers = ''.join(re.escape(stopper) for stopper in sorted(stoppers))
+    return whitespace_tail_regex(rf'(?:[^{escaped_stoppers}\\\s]|\$(?![a-zA-Z_])|\\.)+')
+
+
+_TEXT_STOPPERS = frozenset({'[', '(', '$'})
+_NEWLINE_STOPPERS = frozenset({'\n'})
+_ARGUMENT_STOPPERS = frozenset({',', ')'})
+_INTERPOLATION_STOPPERS = frozenset({':', ']'})
+_ALTERNATION_STOPPERS = frozenset({'|', ':', ']'})
+_POSITIVE_ATTENTION_STOPPERS = frozenset({':', ')'})
+_EMPTY_STEP_FOLLOWERS = frozenset({',', ':', ']'})
+
+_SYMBOL = whitespace_tail_regex('[a-zA-Z_][a-zA-Z0-9_]*')
+_FLOAT = whitespace_tail_regex(r'[+-]?(?:\d+(?:\.\d*)?|\.\d+)')
+_INT_NOT_FLOAT = whitespace_tail_regex(r'[+-]?\d+(?!\.)')
+_FUNCTION_NAME = whitespace_tail_regex('|'.join(('linear', 'catmull', 'bezier', 'mean')))
+_EQUALS = whitespace_tail_regex(re.escape('='))
+_COMMA = whitespace_tail_regex(re.escape(','))
+_COLON = whitespace_tail_regex(re.escape(':'))
+_VERTICAL_BAR = whitespace_tail_regex(re.escape('|'))
+_OPEN_SQUARE = whitespace_tail_regex(re.escape('['))
+_CLOSE_SQUARE = whitespace_tail_regex(re.escape(']'))
+_OPEN_PAREN = whitespace_tail_regex(re.escape('('))
+_CLOSE_PAREN = whitespace_tail_regex(re.escape(')'))
+_NEWLINE = whitespace_tail_regex('\n|$')
+_FUSION_SYNTAX = re.compile(r'[$\[\]]|:\s*[+-]?(?:\d+(?:\.\d*)?|\.\d+)\s*,')
+
+_DISPATCH_PARSERS = {
+    '$': (
+        parse_declaration,
+        parse_substitution,
+    ),
+    '(': (
+        parse_positive_attention,
+    ),
+    '[': (
+        parse_negative_attention,
+        parse_editing,
+        parse_alternation,
+        parse_interpolation,
+    ),
+}
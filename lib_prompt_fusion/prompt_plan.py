@@ -0,0 +1,515 @@
+import math
+import sys
+import time
+from typing import NamedTuple, Optional, Tuple, Union
+from lib_prompt_fusion import interpolation_functions, interpolation_tensor, prompt_limits
+from lib_prompt_fusion.t_scaler import scale_t, scale_t_table
+
+
+class TextNode(NamedTuple):
+    fragment: int
+
+
+class ListNode(NamedTuple):
+    children: Tuple[int, ...]
+
+
+class InterpolationNode(NamedTuple):
+    children: Tuple[int, ...]
+    function: int
+
+
+class AlternationNode(NamedTuple):
+    children: Tuple[int, ...]
+
+
+class EditingNode(NamedTuple):
+    children: Tuple[int, ...]
+    step: Optional[int]
+
+
+class WeightedNode(NamedTuple):
+    child: int
+    weight: Optional[int]
+    positive: bool
+
+
+class WeightInterpolationNode(NamedTuple):
+    child: int
+    weight_begin: int
+    weight_end: int
+
+
+class ConstantNode(NamedTuple):
+    text: str
+    value: Union[int, float]
+
+
+class InterpolationFunctionDescriptor(NamedTuple):
+    name: str
+    operands: Tuple[Optional[int], ...]
+
+
+class Binding(NamedTuple):
+    total_steps: int
+    is_hires: bool
+    use_old_scheduling: bool
+    attention_interpolation_points: int = 0
+
+
+class UnknownSymbolError(ValueError):
+    def __init__(self, symbol):
+        super().__init__(f'${symbol} is not defined')
+        self.symbol = symbol
+
+
+class PlanMetrics(NamedTuple):
+    ast_depth: int = 0
+    substitution_depth: int = 0
+    compile_seconds: float = 0.
+
+
+class PlanCompiler:
+    def __init__(self):
+        self.__fragments = []
+        self.__fragment_indices = {}
+        self.__nodes = []
+        self.__node_indices = {}
+        self.__functions = []
+        self.__function_indices = {}
+        self.__limits_guard = prompt_limits.get_guard()
+        self.__ast_depth = 0
+        self.__max_ast_depth = 0
+        self.__substitution_depth = 0
+        self.__max_substitution_depth = 0
+
+    def compile(self, expr, context):
+        self.__ast_depth += 1
+        try:
+            self.__max_ast_depth = max(self.__max_ast_depth, self.__ast_depth)
+            if self.__limits_guard is not None:
+                self.__limits_guard.check_ast_depth(self.__ast_depth)
+            return expr.compile(self, context)
+        finally:
+            self.__ast_depth -= 1
+
+    def compile_substitution(self, expr, context):
+        self.__substitution_depth += 1
+        try:
+            self.__max_substitution_depth = max(self.__max_substitution_depth, self.__substitution_depth)
+            if self.__limits_guard is not None:
+                self.__limits_guard.check_substitution_depth(self.__substitution_depth)
+            return self.compile(expr, context)
+        finally:
+            self.__substitution_depth -= 1
+
+    def compile_number(self, expr, context):
+        node_index = self.compile(expr, context)
+        text = self.__render_static(node_index)
+        if text is None:
+            return node_index
+
+        try:
+            value = int(text)
+        except ValueError:
+            try:
+                value = float(text)
+            except ValueError:
+                return node_index
+
+        return self.add_node(ConstantNode(text, value))
+
+    def add_fragment(self, text):
+        return self.__intern(text, text, self.__fragments, self.__fragment_indices)
+
+    def add_node(self, node):
+        return self.__intern((type(node), node), node, self.__nodes, self.__node_indices)
+
+    def add_function(self, descriptor):
+        return self.__intern(descriptor, descriptor, self.__functions, self.__function_indices)
+
+    def build(self, root, compile_seconds=0.):
+        metrics = PlanMetrics(self.__max_ast_depth, self.__max_substitution_depth, compile_seconds)
+        return PromptPlan(tuple(self.__fragments), tuple(self.__nodes), tuple(self.__functions), root, metrics)
+
+    def __render_static(self, node_index):
+        node = self.__nodes[node_index]
+        if type(node) is TextNode:
+            return self.__fragments[node.fragment]
+        elif type(node) is ConstantNode:
+            return node.text
+        elif type(node) is ListNode:
+            texts = [self.__render_static(child) for child in node.children]
+            if None not in texts:
+                return ' '.join(texts)
+
+        return None
+
+    @staticmethod
+    def __intern(key, value, table, indices):
+        index = indices.get(key)
+        if index is None:
+            index = indices[key] = len(table)
+            table.append(value)
+
+        return index
+
+
+def compile_prompt(expr, context=None):
+    start = time.monotonic()
+    compiler = PlanCompiler()
+    root = compiler.compile(expr, context if context is not None else dict())
+    return compiler.build(root, time.monotonic() - start)
+
+
+class PromptPlan:
+    def __init__(self, fragments, nodes, functions, root, metrics=PlanMetrics()):
+        self.fragments = fragments
+        self.nodes = nodes
+        self.functions = functions
+        self.root = root
+        self.metrics = metrics
+
+    def get_nbytes(self):
+        return (
+            sys.getsizeof(self.fragments) + sum(sys.getsizeof(fragment) for fragment in self.fragments) +
+            sys.getsizeof(self.nodes) + sum(_get_node_nbytes(node) for node in self.nodes) +
+            sys.getsizeof(self.functions) + sum(sys.getsizeof(function) + sys.getsizeof(function.operands) for function in self.functions)
+        )
+
+    def bind(self, total_steps, is_hires, use_old_scheduling, attention_interpolation_points=0):
+        binding = Binding(total_steps, is_hires, use_old_scheduling, attention_interpolation_points)
+        tensor_builder = interpolation_tensor.InterpolationTensorBuilder()
+        self.extend_tensor(tensor_builder, (0, binding.total_steps), *binding)
+        return tensor_builder
+
+    def extend_tensor(self, tensor_builder, steps_range, total_steps, is_hires, use_old_scheduling, attention_interpolation_points=0):
+        binding = Binding(total_steps, is_hires, use_old_scheduling, attention_interpolation_points)
+        self.extend_node(self.root, tensor_builder, steps_range, binding)
+
+    def extend_node(self, node_index, tensor_builder, steps_range, binding):
+        limits_guard = prompt_limits.get_guard()
+        if limits_guard is not None:
+            limits_guard.check_deadline()
+
+        node = self.nodes[node_index]
+        _node_extenders[type(node)](self, node, tensor_builder, steps_range, binding)
+
+    def eval_int_or_float(self, node_index, steps_range, binding):
+        node = self.nodes[node_index]
+        if type(node) is ConstantNode:
+            return node.value
+
+        mock_builder = interpolation_tensor.InterpolationTensorBuilder()
+        self.extend_node(node_index, mock_builder, steps_range, binding)
+        text = mock_builder.get_prompt(0)
+        try:
+            return int(text)
+        except ValueError:
+            return float(text)
+
+    def eval_step(self, node_index, steps_range, binding):
+        step = self.eval_int_or_float(node_index, steps_range, binding)
+        return step, _scale_step(step, binding)
+
+    def tensor_updater(self, node_index, steps_range, binding):
+        return lambda t: self.extend_node(node_index, t, steps_range, binding)
+
+    def bind_function(self, function_index, children_count, steps_range, binding):
+        descriptor = self.functions[function_index]
+        return _function_binders[descriptor.name](self, descriptor, children_count, steps_range, binding)
+
+
+def _get_node_nbytes(node):
+    nbytes = sys.getsizeof(node)
+    if type(node) is ConstantNode:
+        nbytes += sys.getsizeof(node.text)
+    elif type(node) in (ListNode, InterpolationNode, AlternationNode, EditingNode):
+        nbytes += sys.getsizeof(node.children)
+    return nbytes
+
+
+def _scale_step(step, binding):
+    if binding.use_old_scheduling and 0 < step < 1:
+        step *= binding.total_steps
+    elif not binding.use_old_scheduling and isinstance(step, float):
+        step = (step - int(binding.is_hires)) * binding.total_steps
+    else:
+        step += 1
+
+    return int(step)
+
+
+def _extend_text(plan, node, tensor_builder, _steps_range, _binding):
+    tensor_builder.append(plan.fragments[node.fragment])
+
+
+def _extend_constant(_plan, node, tensor_builder, _steps_range, _binding):
+    tensor_builder.append(node.text)
+
+
+def _extend_list(plan, node, tensor_builder, steps_range, binding):
+    for child_i, child in enumerate(node.children):
+        if child_i >= 1:
+            tensor_builder.append(' ')
+        plan.extend_node(child, tensor_builder, steps_range, binding)
+
+
+def _extend_interpolation(plan, node, tensor_builder, steps_range, binding):
+    tensor_builder.extrude(
+        [plan.tensor_updater(child, steps_range, binding) for child in node.children],
+        plan.bind_function(node.function, len(node.children), steps_range, binding))
+
+
+def _extend_alternation(plan, node, tensor_builder, steps_range, binding):
+    tensor_builder.append('[')
+    for child_i, child in enumerate(node.children):
+        if child_i >= 1:
+            tensor_builder.append('|')
+        plan.extend_node(child, tensor_builder, steps_range, binding)
+    tensor_builder.append(']')
+
+
+def _extend_editing(plan, node, tensor_builder, steps_range, binding):
+    if node.step is None:
+        tensor_builder.append('[')
+        for child in node.children:
+            plan.extend_node(child, tensor_builder, steps_range, binding)
+            tensor_builder.append(':')
+        tensor_builder.append(']')
+        return
+
+    step, step_int = plan.eval_step(node.step, steps_range, binding)
+
+    tensor_builder.append('[')
+    for child_i, child in enumerate(node.children):
+        child_steps_range = (steps_range[0], step_int) if child_i == 0 and len(node.children) >= 2 else (step_int, steps_range[1])
+        plan.extend_node(child, tensor_builder, child_steps_range, binding)
+        tensor_builder.append(':')
+
+    tensor_builder.append(f'{step}]')
+
+
+def _extend_weighted(plan, node, tensor_builder, steps_range, binding):
+    open_bracket, close_bracket = ('(', ')') if node.positive else ('[', ']')
+    tensor_builder.append(open_bracket)
+    plan.extend_node(node.child, tensor_builder, steps_range, binding)
+
+    if node.weight is not None:
+        tensor_builder.append(':')
+        plan.extend_node(node.weight, tensor_builder, steps_range, binding)
+
+    tensor_builder.append(close_bracket)
+
+
+def _extend_weight_interpolation(plan, node, tensor_builder, steps_range, binding):
+    steps_range_size = steps_range[1] - steps_range[0]
+
+    weight_begin = plan.eval_int_or_float(node.weight_begin, steps_range, binding)
+    weight_end = plan.eval_int_or_float(node.weight_end, steps_range, binding)
+
+    if binding.attention_interpolation_points >= 2 and steps_range_size >= 1:
+        _extend_embedding_weight_interpolation(plan, node.child, tensor_builder, steps_range, binding, weight_begin, weight_end)
+        return
+
+    for i in range(steps_range_size):
+        step = i + steps_range[0]
+        weight = weight_begin + (weight_end - weight_begin) * (i / max(steps_range_size - 1, 1))
+
+        is_edited_in = step > steps_range[0]
+        is_edited_out = step + 1 < steps_range[1]
+        weighted_steps_range = (
+            step if is_edited_in else steps_range[0],
+            step + 1 if is_edited_out else steps_range[1],
+        )
+
+        if is_edited_out:
+            tensor_builder.append('[')
+        if is_edited_in:
+            tensor_builder.append('[')
+
+        tensor_builder.append('(')
+        plan.extend_node(node.child, tensor_builder, weighted_steps_range, binding)
+        tensor_builder.append(f':{weight})')
+
+        if is_edited_in:
+            tensor_builder.append(f':{step - 1}]')
+        if is_edited_out:
+            tensor_builder.append(f'::{step}]')
+
+
+def _extend_embedding_weight_interpolation(plan, child, tensor_builder, steps_range, binding, weight_begin, weight_end):
+    steps_range_size = steps_range[1] - steps_range[0]
+    points_count = min(binding.attention_interpolation_points, steps_range_size)
+    if points_count < 2 or weight_begin == weight_end:
+        _weighted_updater(plan, child, weight_begin, steps_range, binding)(tensor_builder)
+        return
+
+    weights = [weight_begin + (weight_end - weight_begin) * (k / (points_count - 1)) for k in range(points_count)]
+    steps = [steps_range[0] + (steps_range_size - 1) * (k / (points_count - 1)) for k in range(points_count)]
+    tensor_builder.extrude(
+        [_weighted_updater(plan, child, weight, steps_range, binding) for weight in weights],
+        CurveInterpolationFunction(interpolation_functions.compute_linear, interpolation_functions.get_linear_active_control_points, steps, binding.total_steps, points_count))
+
+
+def _weighted_updater(plan, child, weight, steps_range, binding):
+    def update_tensor(tensor_builder):
+        tensor_builder.append('(')
+        plan.extend_node(child, tensor_builder, steps_range, binding)
+        tensor_builder.append(f':{float(weight)})')
+
+    return update_tensor
+
+
+_node_extenders = {
+    TextNode: _extend_text,
+    ConstantNode: _extend_constant,
+    ListNode: _extend_list,
+    InterpolationNode: _extend_interpolation,
+    AlternationNode: _extend_alternation,
+    EditingNode: _extend_editing,
+    WeightedNode: _extend_weighted,
+    WeightInterpolationNode: _extend_weight_interpolation,
+}
+
+
+class CurveInterpolationFunction:
+    def __init__(self, function, get_active_control_points, steps, total_steps, children_count):
+        self.function = function
+        self.get_function_active_control_points = get_active_control_points
+        self.steps = steps
+        self.total_steps = total_steps
+        self.children_count = children_count
+        self.scaled_ts = scale_t_table([self.get_unscaled_t(step / total_steps) for step in range(total_steps)], steps)
+        self.segments = interpolation_functions.get_segment_table(self.scaled_ts, children_count)
+
+    def __call__(self, conds, params: interpolation_tensor.InterpolationParams):
+        return self.function(conds, *self.scale_params_and_segment(params, len(conds)))
+
+    def get_active_control_points(self, count, params: interpolation_tensor.InterpolationParams):
+        return self.get_function_active_control_points(count, *self.scale_params_and_segment(params, count))
+
+    def get_params_key(self, params: interpolation_tensor.InterpolationParams):
+        return self.scale_params(params).t
+
+    def scale_params(self, params: interpolation_tensor.InterpolationParams):
+        return self.scale_params_and_segment(params, self.children_count)[0]
+
+    def scale_params_and_segment(self, params: interpolation_tensor.InterpolationParams, count):
+        if params.total_steps == self.total_steps and 0 <= params.step < self.total_steps and params.t == params.step / self.total_steps:
+            scaled_params = interpolation_tensor.InterpolationParams(self.scaled_ts[params.step], *params[1:])
+            return scaled_params, self.segments[params.step] if count == self.children_count else None
+
+        scaled_t = scale_t(self.get_unscaled_t(params.t), self.steps)
+        return interpolation_tensor.InterpolationParams(scaled_t, *params[1:]), None
+
+    def get_unscaled_t(self, t):
+        return (t * self.total_steps - self.steps[0]) / max(1, self.steps[-1] - self.steps[0])
+
+
+class AverageInterpolationFunction:
+    def __init__(self, weights):
+        self.weights = weights
+
+    def __call__(self, conds, _params):
+        total = None
+        for cond, weight in zip(conds, self.weights):
+            cond = cond * weight
+            if total is None:
+                total = cond
+            else:
+                total += cond
+
+        return total
+
+    def get_active_control_points(self, count, _params):
+        return range(count)
+
+    def get_params_key(self, _params):
+        return None
+
+
+class WrapInterpolationFunction:
+    def __init__(self, speed, children_count, steps_range, total_steps):
+        self.speed = speed
+        self.children_count = children_count
+        self.steps_range = steps_range
+        self.total_steps = total_steps
+
+    def __call__(self, control_points, params: interpolation_tensor.InterpolationParams):
+        return interpolation_functions.compute_linear(control_points, self.wrap_params(params))
+
+    def get_active_control_points(self, count, params: interpolation_tensor.InterpolationParams):
+        return interpolation_functions.get_linear_active_control_points(count, self.wrap_params(params))
+
+    def get_params_key(self, params: interpolation_tensor.InterpolationParams):
+        return self.wrap_params(params).t
+
+    def wrap_params(self, params: interpolation_tensor.InterpolationParams):
+        wrapped_t = math.fmod((params.t * self.total_steps - self.steps_range[0]) / (self.children_count - 1) * self.speed, 1.0)
+        if wrapped_t < 0:
+            wrapped_t = wrapped_t + 1
+        return interpolation_tensor.InterpolationParams(wrapped_t, *params[1:])
+
+
+def _bind_curve(plan, descriptor, children_count, steps_range, binding):
+    steps = list(descriptor.operands)
+    for i, step in enumerate(steps):
+        if step is not None:
+            _, steps[i] = plan.eval_step(step, steps_range, binding)
+
+    if steps[0] is None:
+        steps[0] = steps_range[0]
+    if steps[-1] is None:
+        steps[-1] = steps_range[1]
+
+    i = 1
+    while i < len(steps):
+        none_len = 0
+        while steps[i + none_len] is None:
+            none_len += 1
+
+        min_step, max_step = steps[i - 1], steps[i + none_len]
+
+        for j in range(none_len):
+            steps[i + j] = min_step + (max_step - min_step) * (j + 1) / (none_len + 1)
+
+        i += 1 + none_len
+
+    function, get_active_control_points = {
+        'linear': (interpolation_functions.compute_linear, interpolation_functions.get_linear_active_control_points),
+        'bezier': (interpolation_functions.compute_bezier, interpolation_functions.get_bezier_active_control_points),
+        'catmull': (interpolation_functions.compute_catmull, interpolation_functions.get_catmull_active_control_points),
+    }[descriptor.name]
+
+    return CurveInterpolationFunction(function, get_active_control_points, steps, binding.total_steps, children_count)
+
+
+def _bind_average(plan, descriptor, children_count, steps_range, binding):
+    weights = [
+        plan.eval_int_or_float(weight, steps_range, binding) if weight is not None else None
+        for weight in descriptor.operands
+    ]
+    explicit_weights = [weight for weight in weights if weight is not None]
+    weights = [
+        weight / sum(explicit_weights) * len(explicit_weights) / children_count
+        if weight is not None
+        else 1 / children_count
+        for weight in weights
+    ]
+    weights.extend(1 / children_count for _ in range(children_count - len(weights)))
+    return AverageInterpolationFunction(weights)
+
+
+def _bind_wrap(plan, descriptor, children_count, steps_range, binding):
+    speed = plan.eval_int_or_float(descriptor.operands[0], steps_range, binding)
+    return WrapInterpolationFunction(speed, children_count, steps_range, binding.total_steps)
+
+
+_function_binders = {
+    'linear': _bind_curve,
+    'bezier': _bind_curve,
+    'catmull': _bind_curve,
+    'mean': _bind_average,
+    'wrap': _bind_wrap,
+}
@@ -0,0 +1,262 @@
+import contextlib
+import hashlib
+import inspect
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import torch
+from multiprocessing import shared_memory, resource_tracker
+from modules import prompt_parser
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+_header_format = '<Q'
+_header_size = struct.calcsize(_header_format)
+_alignment = 64
+_supports_untracked_memory = 'track' in inspect.signature(shared_memory.SharedMemory).parameters
+
+
+class SharedMemoryConditioningCache:
+    index_bytes = 1024 * 1024
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__name = None
+        self.__max_bytes = 0
+        self.__index_memory = None
+
+    def configure(self, name, max_bytes):
+        with self.__lock:
+            name = name or None
+            if name != self.__name:
+                if self.__index_memory is not None:
+                    self.__index_memory.close()
+                    self.__index_memory = None
+                self.__name = name
+
+            self.__max_bytes = max_bytes
+
+    def is_enabled(self):
+        return fcntl is not None and self.__name is not None and self.__max_bytes > 0
+
+    def get(self, key, device):
+        if not self.is_enabled():
+            return None
+
+        digest = _get_digest(key)
+        with self.__locked_index() as index:
+            entry = index.get(digest)
+            if entry is None:
+                return None
+
+            try:
+                memory = _open_shared_memory(entry['segment'])
+            except FileNotFoundError:
+                del index[digest]
+                return None
+
+            try:
+                schedules = _read_schedules(memory.buf, device)
+            finally:
+                memory.close()
+
+            entry['last_used'] = time.time()
+            return schedules
+
+    def put(self, key, schedules):
+        if not self.is_enabled():
+            return
+
+        digest = _get_digest(key)
+        header, tensors = _serialize_schedules(schedules)
+        size = _header_size + len(header) + sum(tensor.nelement() for tensor in tensors) + _alignment * len(tensors)
+        if size > self.__max_bytes:
+            return
+
+        with self.__locked_index() as index:
+            if digest in index:
+                return
+
+            _evict(index, self.__max_bytes - size)
+            segment = f'{self.__name}_{digest[:32]}'
+            try:
+                memory = _open_shared_memory(segment, create=True, size=size)
+            except FileExistsError:
+                _unlink_shared_memory(segment)
+                memory = _open_shared_memory(segment, create=True, size=size)
+
+            try:
+                _write_schedules(memory.buf, header, tensors)
+            finally:
+                memory.close()
+
+            index[digest] = {'segment': segment, 'size': size, 'last_used': time.time()}
+
+    def stats(self):
+        if not self.is_enabled():
+            return {'entries': 0, 'bytes': 0}
+
+        with self.__locked_index() as index:
+            return {'entries': len(index), 'bytes': sum(entry['size'] for entry in index.values())}
+
+    def clear(self):
+        if not self.is_enabled():
+            return
+
+        with self.__locked_index() as index:
+            _evict(index, -1)
+
+    @contextlib.contextmanager
+    def __locked_index(self):
+        with self.__lock, open(_get_lock_path(self.__name), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index_memory = self.__get_index_memory()
+                index = _read_index(index_memory.buf)
+                yield index
+                while not _write_index(index_memory.buf, index):
+                    _evict(index, sum(entry['size'] for entry in index.values()) // 2)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __get_index_memory(self):
+        if self.__index_memory is None:
+            try:
+                self.__index_memory = _open_shared_memory(f'{self.__name}_index')
+            except FileNotFoundError:
+                self.__index_memory = _open_shared_memory(f'{self.__name}_index', create=True, size=self.index_bytes)
+                _write_index(self.__index_memory.buf, {})
+
+        return self.__index_memory
+
+
+def unlink(name):
+    _unlink_shared_memory(f'{name}_index')
+    try:
+        os.remove(_get_lock_path(name))
+    except OSError:
+        pass
+
+
+def _get_lock_path(name):
+    return os.path.join(tempfile.gettempdir(), f'{name}.lock')
+
+
+def _open_shared_memory(name, create=False, size=0):
+    if _supports_untracked_memory:
+        return shared_memory.SharedMemory(name, create=create, size=size, track=False)
+
+    memory = shared_memory.SharedMemory(name, create=create, size=size)
+    resource_tracker.unregister(memory._name, 'shared_memory')
+    return memory
+
+
+def _unlink_shared_memory(name):
+    try:
+        memory = _open_shared_memory(name)
+    except FileNotFoundError:
+        return
+
+    memory.close()
+    if not _supports_untracked_memory:
+        resource_tracker.register(memory._name, 'shared_memory')
+    memory.unlink()
+
+
+def _evict(index, max_bytes):
+    total_bytes = sum(entry['size'] for entry in index.values())
+    for digest, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+        if total_bytes <= max_bytes:
+            break
+
+        _unlink_shared_memory(entry['segment'])
+        del index[digest]
+        total_bytes -= entry['size']
+
+
+def _read_index(buffer):
+    length, = struct.unpack_from(_header_format, buffer)
+    if length == 0:
+        return {}
+
+    return json.loads(bytes(buffer[_header_size:_header_size + length]))
+
+
+def _write_index(buffer, index):
+    data = json.dumps(index).encode()
+    if _header_size + len(data) > len(buffer):
+        return False
+
+    buffer[_header_size:_header_size + len(data)] = data
+    struct.pack_into(_header_format, buffer, 0, len(data))
+    return True
+
+
+def _serialize_schedules(schedules):
+    tensors = []
+    header = []
+    for schedule in schedules:
+        if isinstance(schedule.cond, dict):
+            conds = list(schedule.cond.items())
+        else:
+            conds = [(None, schedule.cond)]
+
+        entries = []
+        for k, cond in conds:
+            cond = cond.detach().contiguous().cpu()
+            entries.append([k, str(cond.dtype).removeprefix('torch.'), list(cond.shape)])
+            tensors.append(cond.reshape(-1).view(torch.uint8))
+        header.append({'end_at_step': schedule.end_at_step, 'conds': entries})
+
+    return json.dumps(header).encode(), tensors
+
+
+def _write_schedules(buffer, header, tensors):
+    struct.pack_into(_header_format, buffer, 0, len(header))
+    buffer[_header_size:_header_size + len(header)] = header
+    offset = _header_size + len(header)
+    for tensor in tensors:
+        offset = _align(offset)
+        if tensor.nelement() > 0:
+            torch.frombuffer(buffer, dtype=torch.uint8, count=tensor.nelement(), offset=offset).copy_(tensor)
+        offset += tensor.nelement()
+
+
+def _read_schedules(buffer, device):
+    header_length, = struct.unpack_from(_header_format, buffer)
+    header = json.loads(bytes(buffer[_header_size:_header_size + header_length]))
+    offset = _header_size + header_length
+
+    schedules = []
+    for schedule in header:
+        conds = {}
+        for k, dtype, shape in schedule['conds']:
+            dtype = getattr(torch, dtype)
+            offset = _align(offset)
+            nbytes = torch.Size(shape).numel() * torch.empty((), dtype=dtype).element_size()
+            if nbytes > 0:
+                cond = torch.frombuffer(buffer, dtype=torch.uint8, count=nbytes, offset=offset).view(dtype).reshape(shape).to(device=device, copy=True)
+            else:
+                cond = torch.empty(shape, dtype=dtype, device=device)
+            conds[k] = cond
+            offset += nbytes
+
+        cond = conds[None] if None in conds else conds
+        schedules.append(prompt_parser.ScheduledPromptConditioning(cond=cond, end_at_step=schedule['end_at_step']))
+
+    return schedules
+
+
+def _align(offset):
+    return (offset + _alignment - 1) // _alignment * _alignment
+
+
+def _get_digest(key):
+    return hashlib.sha256(repr(key).encode()).hexdigest()
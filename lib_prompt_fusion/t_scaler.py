@@ -1,3 +1,6 @@
+import torch
+
+
 def scale_t(t, positions):
     if t >= 1.:
         return 1.
@@ -5,18 +8,7 @@ def scale_t(t, positions):
     if t <= 0.:
         return 0.
 
-    distances = []
-    for i in range(len(positions)-1):
-        distances.append(positions[i+1] - positions[i])
-
-    total_distance = sum(distances)
-    for i in range(len(distances)):
-        distances[i] = distances[i]/total_distance
-
-    for i in range(len(distances)-1):
-        distances[i+1] = distances[i] + distances[i+1]
-
-    distances.insert(0, 0.0)
+    distances = get_cumulative_distances(positions)
 
     spline_index = 0
     for i, distance in enumerate(distances):
@@ -32,6 +24,44 @@ def scale_t(t, positions):
     return (spline_index + local_ratio)/(len(distances)-1)
 
 
+def scale_t_table(ts, positions):
+    if all(t <= 0. or t >= 1. for t in ts):
+        return [scale_t(t, positions) for t in ts]
+
+    distances = get_cumulative_distances(positions)
+    if any(b < a for a, b in zip(distances, distances[1:])):
+        return [scale_t(t, positions) for t in ts]
+
+    ts = torch.tensor(ts, dtype=torch.float64)
+    distances = torch.tensor(distances, dtype=torch.float64)
+    spline_indices = (torch.searchsorted(distances, ts, side='left') - 1).clamp(0, len(distances) - 1)
+    segment_indices = spline_indices.clamp(max=len(distances) - 2)
+    segment_begins = distances[segment_indices]
+    local_ratios = (ts - segment_begins) / (distances[segment_indices + 1] - segment_begins)
+    scaled_ts = (spline_indices + local_ratios) / (len(distances) - 1)
+
+    scaled_ts = torch.where(spline_indices >= len(distances) - 1, 1., scaled_ts)
+    scaled_ts = torch.where(ts <= 0., 0., scaled_ts)
+    scaled_ts = torch.where(ts >= 1., 1., scaled_ts)
+    return scaled_ts.tolist()
+
+
+def get_cumulative_distances(positions):
+    distances = []
+    for i in range(len(positions)-1):
+        distances.append(positions[i+1] - positions[i])
+
+    total_distance = sum(distances)
+    for i in range(len(distances)):
+        distances[i] = distances[i]/total_distance
+
+    for i in range(len(distances)-1):
+        distances[i+1] = distances[i] + distances[i+1]
+
+    distances.insert(0, 0.0)
+    return distances
+
+
 if __name__ == "__main__":
     total_steps = 20
     for i in range(total_steps):
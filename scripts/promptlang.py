@@ -1,5 +1,6 @@
 import gradio as gr
-from lib_prompt_fusion import hijacker, empty_cond, global_state, interpolation_tensor, prompt_parser as prompt_fusion_parser
+from typing import Optional
+from lib_prompt_fusion import hijacker, cost_estimator, empty_cond, fusion_context, global_state, interpolation_tensor, lazy_schedule, prompt_limits, prompt_plan, prompt_parser as prompt_fusion_parser
 from modules import scripts, script_callbacks, prompt_parser, shared
 
 
@@ -16,16 +17,92 @@ def on_ui_settings():
     shared.opts.add_option('prompt_fusion_slerp_scale', shared.OptionInfo(0, 'Slerp scale (0 = linear geometry, 1 = slerp geometry)', component=gr.Number, section=section))
     shared.opts.add_option('prompt_fusion_slerp_negative_origin', shared.OptionInfo(True, 'use negative prompt as slerp origin', section=section))
     shared.opts.add_option('prompt_fusion_slerp_epsilon', shared.OptionInfo(0.0001, 'Slerp epsilon (fallback on linear geometry when conds are too similar. 0 = parallel, 1 = perpendicular)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_attention_interpolation_points', shared.OptionInfo(0, 'Attention interpolation points (0 = one weighted prompt per step, N >= 2 = encode N weights and interpolate the embeddings in between)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_parse_cache_size', shared.OptionInfo(256, 'Parse cache capacity (number of distinct prompts kept parsed in memory, 0 = disabled)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_disk_cache_dir', shared.OptionInfo('', 'Persistent conditioning cache directory (empty = disabled)', section=section))
+    shared.opts.add_option('prompt_fusion_disk_cache_size', shared.OptionInfo(1024, 'Persistent conditioning cache budget in MB', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_shared_memory_cache_name', shared.OptionInfo('', 'Shared memory conditioning cache name, shared by every webui process using the same name on this host (empty = disabled)', section=section))
+    shared.opts.add_option('prompt_fusion_shared_memory_cache_size', shared.OptionInfo(1024, 'Shared memory conditioning cache budget in MB', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_max_ast_depth', shared.OptionInfo(0, 'Maximum prompt nesting depth after substitutions (0 = unlimited)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_max_substitution_depth', shared.OptionInfo(0, 'Maximum nested $substitution depth (0 = unlimited)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_max_prompt_database_size', shared.OptionInfo(0, 'Maximum number of expanded prompts per input prompt (0 = unlimited)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_max_expanded_characters', shared.OptionInfo(0, 'Maximum total characters of the expanded prompts per input prompt (0 = unlimited)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_max_compile_seconds', shared.OptionInfo(0, 'Maximum seconds spent parsing and expanding the prompts of one request (0 = unlimited)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_schedule_cache_size', shared.OptionInfo(256, 'Schedule cache budget in MB (keeps the conditionings of recent prompts in VRAM so repeated prompts skip parsing, text encoding and interpolation, 0 = disabled)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_lazy_schedule_cache_size', shared.OptionInfo(2, 'Interpolated conditionings kept per prompt while sampling (raise when several prompts or samplers read their schedules out of step order)', component=gr.Number, section=section))
+    shared.opts.add_option('prompt_fusion_instrumentation_enabled', shared.OptionInfo(False, 'Record per-phase timings of the conditioning pipeline (readable at /prompt-fusion/instrumentation)', section=section))
+    shared.opts.add_option('prompt_fusion_instrumentation_buffer_size', shared.OptionInfo(1024, 'Number of recorded phases kept in memory', component=gr.Number, section=section))
 
 
 script_callbacks.on_ui_settings(on_ui_settings)
 
 
+def on_app_started(_demo, app):
+    import fastapi
+
+    @app.post('/prompt-fusion/explain')
+    def explain_prompt(
+        prompt: str = fastapi.Body(...),
+        steps: int = fastapi.Body(20),
+        hires_steps: Optional[int] = fastapi.Body(None),
+        use_old_scheduling: bool = fastapi.Body(False),
+        model_type: str = fastapi.Body('sd1'),
+    ):
+        try:
+            cost = cost_estimator.explain_prompt(
+                prompt, steps, hires_steps, use_old_scheduling, model_type,
+                attention_interpolation_points=global_state.get_attention_interpolation_points(),
+                limits=global_state.get_prompt_limits(),
+                lazy_schedule_cache_size=global_state.get_lazy_schedule_cache_size())
+        except prompt_limits.PromptLimitError as e:
+            raise fastapi.HTTPException(status_code=422, detail=e.to_dict())
+        except (ValueError, AssertionError) as e:
+            raise fastapi.HTTPException(status_code=422, detail={'error': type(e).__name__, 'message': str(e)})
+
+        return cost._asdict()
+
+    @app.get('/prompt-fusion/instrumentation')
+    def get_instrumentation():
+        return {
+            'enabled': global_state.phase_recorder.is_enabled(),
+            'stats': global_state.phase_recorder.stats(),
+            'records': [record._asdict() for record in global_state.phase_recorder.records()],
+        }
+
+    @app.get('/prompt-fusion/instrumentation/trace')
+    def get_instrumentation_trace():
+        return global_state.phase_recorder.chrome_trace()
+
+    @app.delete('/prompt-fusion/instrumentation')
+    def clear_instrumentation():
+        global_state.phase_recorder.clear()
+
+
+script_callbacks.on_app_started(on_app_started)
+
+
 @prompt_parser_hijacker.hijack('get_learned_conditioning')
 def _hijacked_get_learned_conditioning(model, prompts, total_steps, *args, original_function, **kwargs):
     if not shared.opts.prompt_fusion_enabled:
         return original_function(model, prompts, total_steps, *args, **kwargs)
 
+    global_state.phase_recorder.configure(global_state.get_instrumentation_enabled(), global_state.get_instrumentation_buffer_size())
+    with global_state.phase_recorder.phase('get_learned_conditioning', prompts=len(prompts), steps=total_steps):
+        return _get_learned_conditioning(model, prompts, total_steps, *args, original_function=_instrument_encoder(original_function), **kwargs)
+
+
+def _instrument_encoder(original_function):
+    if not global_state.phase_recorder.is_enabled():
+        return original_function
+
+    def encode(model, prompts, *args, **kwargs):
+        with global_state.phase_recorder.phase('encode', prompts=len(prompts)):
+            return original_function(model, prompts, *args, **kwargs)
+
+    return encode
+
+
+def _get_learned_conditioning(model, prompts, total_steps, *args, original_function, **kwargs):
     hires_steps, use_old_scheduling, *_ = args if args else (None, True)
     is_hires = hires_steps is not None
     if is_hires:
@@ -33,104 +110,317 @@ def _hijacked_get_learned_conditioning(model, prompts, total_steps, *args, origi
     else:
         real_total_steps = total_steps
 
+    context = fusion_context.get()
     if hasattr(prompts, 'is_negative_prompt'):
         is_negative_prompt = prompts.is_negative_prompt
     else:
-        is_negative_prompt = global_state.old_webui_is_negative
+        is_negative_prompt = context.old_webui_is_negative
+
+    unique_prompts = list(dict.fromkeys(prompts))
+    plain_prompts = [prompt for prompt in unique_prompts if prompt_fusion_parser.is_plain_prompt(prompt)]
+    if len(plain_prompts) == len(unique_prompts):
+        schedules = original_function(model, prompts, total_steps, *args, **kwargs)
+        if is_negative_prompt:
+            context_key = _get_context_key(model, prompts, total_steps, hires_steps, use_old_scheduling, None)
+            _set_negative_schedules(context, is_hires, _wrap_schedules(schedules[0]), (prompts[0], context_key))
+        return schedules
+
+    unique_schedules = {}
+    if plain_prompts:
+        plain_conditioning = _new_conditioning(prompts)
+        plain_conditioning.extend(plain_prompts)
+        plain_schedules = original_function(model, plain_conditioning, total_steps, *args, **kwargs)
+        unique_schedules.update(zip(plain_prompts, plain_schedules))
+
+    global_state.schedule_cache.resize(max_bytes=global_state.get_schedule_cache_size())
+    origin_schedules = None if is_negative_prompt else global_state.get_origin_schedules(is_hires)
+    context_key = _get_context_key(model, prompts, total_steps, hires_steps, use_old_scheduling, global_state.get_origin_schedules_key(is_hires) if origin_schedules is not None else None)
+
+    fusion_prompts = [prompt for prompt in unique_prompts if prompt not in unique_schedules]
+    tensor_schedules = {}
+    for prompt in fusion_prompts:
+        schedule = global_state.schedule_cache.get((prompt, context_key))
+        if schedule is not None:
+            tensor_schedules[prompt] = schedule
+
+    missing_prompts = [prompt for prompt in fusion_prompts if prompt not in tensor_schedules]
+    if missing_prompts:
+        with global_state.phase_recorder.phase('empty_cond_init'):
+            empty_cond.init(model)
+        schedules = _get_tensor_schedules(model, prompts, missing_prompts, total_steps, real_total_steps, is_hires, use_old_scheduling, origin_schedules, args, kwargs, original_function)
+        for prompt, schedule in zip(missing_prompts, schedules):
+            tensor_schedules[prompt] = global_state.schedule_cache.put((prompt, context_key), schedule)
+            if (prompt, context_key) in global_state.schedule_cache:
+                schedule.retain_conds()
 
-    empty_cond.init(model)
+    if is_negative_prompt:
+        negative_prompt = unique_prompts[0]
+        if negative_prompt in tensor_schedules:
+            negative_schedules = tensor_schedules[negative_prompt].get_schedules()
+        else:
+            negative_schedules = _wrap_schedules(unique_schedules[negative_prompt])
+        _set_negative_schedules(context, is_hires, negative_schedules, (negative_prompt, context_key))
 
-    tensor_builders = _parse_tensor_builders(prompts, real_total_steps, is_hires, use_old_scheduling)
-    if hasattr(prompt_parser, 'SdConditioning'):
-        empty_conditioning = prompt_parser.SdConditioning(prompts)
-        empty_conditioning.clear()
+    with global_state.phase_recorder.phase('unwrap', prompts=len(tensor_schedules)):
+        unique_schedules.update(
+            (prompt, schedule.get_schedules(unwrap=True))
+            for prompt, schedule in tensor_schedules.items()
+        )
+
+    return [unique_schedules[prompt] for prompt in prompts]
+
+
+def _set_negative_schedules(context, is_hires, schedules, key):
+    if is_hires:
+        context.negative_schedules_hires = schedules
+        context.negative_schedules_hires_key = key
     else:
-        empty_conditioning = []
+        context.negative_schedules = schedules
+        context.negative_schedules_key = key
 
-    flattened_prompts, consecutive_ranges = _get_flattened_prompts(tensor_builders, empty_conditioning)
-    flattened_schedules = original_function(model, flattened_prompts, total_steps, *args, **kwargs)
 
-    if isinstance(flattened_schedules[0][0].cond, dict): # sdxl
+def _wrap_schedules(schedules):
+    if isinstance(schedules[0].cond, dict): # sdxl
         CondWrapper = interpolation_tensor.DictCondWrapper
     else:
         CondWrapper = interpolation_tensor.TensorCondWrapper
 
-    flattened_schedules = [
-        [
-            prompt_parser.ScheduledPromptConditioning(cond=CondWrapper(schedule.cond), end_at_step=schedule.end_at_step)
-            for schedule in subschedules
-        ]
-        for subschedules in flattened_schedules
+    return [
+        prompt_parser.ScheduledPromptConditioning(cond=CondWrapper(schedule.cond), end_at_step=schedule.end_at_step)
+        for schedule in schedules
     ]
 
-    cond_tensors = (tensor_builder.build(flattened_schedules[begin:end], empty_cond.get())
-                    for begin, end, tensor_builder
-                    in zip(consecutive_ranges[:-1], consecutive_ranges[1:], tensor_builders))
 
-    schedules = [_sample_tensor_schedules(cond_tensor, real_total_steps, is_hires)
-                 for cond_tensor in cond_tensors]
+def _get_tensor_schedules(model, prompts, unique_prompts, total_steps, real_total_steps, is_hires, use_old_scheduling, origin_schedules, args, kwargs, original_function):
+    tensor_builders = _parse_tensor_builders(unique_prompts, real_total_steps, is_hires, use_old_scheduling)
+    flattened_prompts, prompt_indices = _get_flattened_prompts(tensor_builders, real_total_steps, _new_conditioning(prompts))
+    flattened_schedules = _get_flattened_schedules(model, flattened_prompts, total_steps, args, kwargs, original_function)
 
-    if is_negative_prompt:
-        if hires_steps is not None:
-            global_state.negative_schedules_hires = schedules[0]
-        else:
-            global_state.negative_schedules = schedules[0]
+    flattened_schedules = [_wrap_schedules(subschedules) for subschedules in flattened_schedules]
+
+    with global_state.phase_recorder.phase('build', prompts=len(tensor_builders), leaves=len(flattened_schedules)):
+        cond_tensors = [tensor_builder.build([flattened_schedules[i] if i is not None else None for i in indices], empty_cond.get())
+                        for indices, tensor_builder
+                        in zip(prompt_indices, tensor_builders)]
+
+    with global_state.phase_recorder.phase('schedule_merge', prompts=len(cond_tensors), steps=real_total_steps):
+        return [_sample_tensor_schedules(cond_tensor, real_total_steps, origin_schedules)
+                for cond_tensor in cond_tensors]
+
+
+def _get_flattened_schedules(model, flattened_prompts, total_steps, args, kwargs, original_function):
+    global_state.conditioning_shared_memory_cache.configure(global_state.get_shared_memory_cache_name(), global_state.get_shared_memory_cache_size())
+    global_state.conditioning_disk_cache.configure(global_state.get_disk_cache_directory(), global_state.get_disk_cache_size())
+    caches = [
+        cache
+        for cache in (global_state.conditioning_shared_memory_cache, global_state.conditioning_disk_cache)
+        if cache.is_enabled()
+    ]
+    model_hash = getattr(model, 'sd_model_hash', None)
+    if not caches or model_hash is None:
+        return _encode_prompts(model, flattened_prompts, total_steps, args, kwargs, original_function)
+
+    hires_steps, use_old_scheduling, *_ = args if args else (None, True)
+    cache_key = (
+        model_hash,
+        getattr(flattened_prompts, 'width', None),
+        getattr(flattened_prompts, 'height', None),
+        total_steps,
+        hires_steps,
+        use_old_scheduling,
+        shared.opts.data.get('CLIP_stop_at_last_layers', None),
+        shared.opts.data.get('emphasis', None),
+        fusion_context.get().extra_network_key,
+        global_state.get_embeddings_fingerprint(),
+        global_state.get_networks_fingerprint(fusion_context.get().extra_network_key),
+    )
+    device = empty_cond.get().to_cp_values()[0].device
+    flattened_schedules = []
+    for prompt in flattened_prompts:
+        schedules = None
+        for i, cache in enumerate(caches):
+            schedules = cache.get((prompt, cache_key), device)
+            if schedules is not None:
+                for missed_cache in caches[:i]:
+                    missed_cache.put((prompt, cache_key), schedules)
+                break
+        flattened_schedules.append(schedules)
+
+    missing_prompts = _new_conditioning(flattened_prompts)
+    missing_prompts.extend(prompt for prompt, schedules in zip(flattened_prompts, flattened_schedules) if schedules is None)
+    if missing_prompts:
+        missing_schedules = iter(_encode_prompts(model, missing_prompts, total_steps, args, kwargs, original_function))
+        for i, prompt in enumerate(flattened_prompts):
+            if flattened_schedules[i] is None:
+                flattened_schedules[i] = next(missing_schedules)
+                for cache in caches:
+                    cache.put((prompt, cache_key), flattened_schedules[i])
+
+    global_state.conditioning_disk_cache.flush()
+    return flattened_schedules
+
+
+def _encode_prompts(model, prompts, total_steps, args, kwargs, original_function):
+    prompt_schedules = _get_prompt_schedules(prompts, total_steps, args)
+    if prompt_schedules is None:
+        return original_function(model, prompts, total_steps, *args, **kwargs)
 
-    schedules = [
-        [
-            prompt_parser.ScheduledPromptConditioning(cond=schedule.cond.original_cond, end_at_step=schedule.end_at_step)
-            for schedule in subschedules
+    conds_key = (
+        global_state.get_model_token(model),
+        getattr(prompts, 'width', None),
+        getattr(prompts, 'height', None),
+        shared.opts.data.get('CLIP_stop_at_last_layers', None),
+        shared.opts.data.get('emphasis', None),
+        fusion_context.get().extra_network_key,
+    )
+    request_conds = fusion_context.get().request_conds
+    missing_prompts = _new_conditioning(prompts)
+    missing_indices = []
+    for i, (prompt, schedule) in enumerate(zip(prompts, prompt_schedules)):
+        if any((conds_key, text) not in request_conds for _, text in schedule):
+            missing_prompts.append(prompt)
+            missing_indices.append(i)
+
+    mismatched_schedules = {}
+    if missing_prompts:
+        encoded_schedules = original_function(model, missing_prompts, total_steps, *args, **kwargs)
+        for i, encoded_schedule in zip(missing_indices, encoded_schedules):
+            if len(prompt_schedules[i]) != len(encoded_schedule):
+                mismatched_schedules[i] = encoded_schedule
+                continue
+
+            for (_, text), schedule in zip(prompt_schedules[i], encoded_schedule):
+                request_conds[(conds_key, text)] = schedule.cond
+
+    return [
+        mismatched_schedules[i] if i in mismatched_schedules else [
+            prompt_parser.ScheduledPromptConditioning(end_at_step=end_at_step, cond=request_conds[(conds_key, text)])
+            for end_at_step, text in schedule
         ]
-        for subschedules in schedules
+        for i, schedule in enumerate(prompt_schedules)
     ]
 
-    return schedules
+
+def _get_prompt_schedules(prompts, total_steps, args):
+    get_prompt_schedules = getattr(prompt_parser, 'get_learned_conditioning_prompt_schedules', None)
+    if get_prompt_schedules is None:
+        return None
+
+    try:
+        return get_prompt_schedules(prompts, total_steps, *args)
+    except TypeError:
+        return get_prompt_schedules(prompts, total_steps)
+
+
+def _new_conditioning(prompts):
+    if hasattr(prompt_parser, 'SdConditioning'):
+        conditioning = prompt_parser.SdConditioning(prompts)
+        conditioning.clear()
+        return conditioning
+
+    return []
+
+
+def _get_context_key(model, prompts, total_steps, hires_steps, use_old_scheduling, origin_key):
+    checkpoint_info = getattr(model, 'sd_checkpoint_info', None)
+    return (
+        global_state.get_model_token(model),
+        getattr(checkpoint_info, 'filename', None),
+        getattr(model, 'sd_model_hash', None),
+        getattr(prompts, 'width', None),
+        getattr(prompts, 'height', None),
+        total_steps,
+        hires_steps,
+        use_old_scheduling,
+        global_state.get_slerp_scale(),
+        global_state.get_slerp_epsilon(),
+        shared.opts.data.get('prompt_fusion_slerp_negative_origin', False),
+        global_state.get_attention_interpolation_points(),
+        shared.opts.data.get('CLIP_stop_at_last_layers', None),
+        shared.opts.data.get('emphasis', None),
+        fusion_context.get().extra_network_key,
+        origin_key,
+    )
 
 
 @prompt_parser_hijacker.hijack('get_multicond_learned_conditioning')
 def _hijacked_get_multicond_learned_conditioning(*args, original_function, **kwargs):
     res = original_function(*args, **kwargs)
-    global_state.old_webui_is_negative = False
+    fusion_context.get().old_webui_is_negative = False
     return res
 
 
 def _parse_tensor_builders(prompts, total_steps, is_hires, use_old_scheduling):
     tensor_builders = []
 
-    for prompt in prompts:
-        expr = prompt_fusion_parser.parse_prompt(prompt)
-        tensor_builder = interpolation_tensor.InterpolationTensorBuilder()
-        expr.extend_tensor(tensor_builder, (0, total_steps), total_steps, dict(), is_hires, use_old_scheduling)
-        tensor_builders.append(tensor_builder)
+    global_state.parse_cache.resize(max_entries=global_state.get_parse_cache_size())
+    attention_interpolation_points = global_state.get_attention_interpolation_points()
+
+    with prompt_limits.enforce(global_state.get_prompt_limits()) as limits_guard:
+        with global_state.phase_recorder.phase('parse', prompts=len(prompts)):
+            plans = [
+                global_state.parse_cache.get_or_create(prompt, lambda: prompt_plan.compile_prompt(prompt_fusion_parser.parse_prompt(prompt)))
+                for prompt in prompts
+            ]
+
+        with global_state.phase_recorder.phase('tensor_build', prompts=len(prompts), steps=total_steps) as tensor_build_phase:
+            for plan in plans:
+                limits_guard.check_plan(plan)
+                tensor_builder = plan.bind(total_steps, is_hires, use_old_scheduling, attention_interpolation_points)
+                limits_guard.check_tensor_builder(tensor_builder)
+                tensor_builders.append(tensor_builder)
+            tensor_build_phase.set(leaves=sum(tensor_builder.get_prompt_database_size() for tensor_builder in tensor_builders))
 
     return tensor_builders
 
 
-def _get_flattened_prompts(tensor_builders, flattened_prompts=None):
+def _get_flattened_prompts(tensor_builders, total_steps, flattened_prompts=None):
     if flattened_prompts is None:
         flattened_prompts = []
-    consecutive_ranges = [0]
+    prompt_indices = []
+    flattened_indices = {}
 
     for tensor_builder in tensor_builders:
-        flattened_prompts.extend(tensor_builder.get_prompt_database())
-        consecutive_ranges.append(len(flattened_prompts))
-
-    return flattened_prompts, consecutive_ranges
-
-
-def _sample_tensor_schedules(tensor, steps, is_hires):
-    schedules = []
+        reachable_indices = tensor_builder.get_reachable_prompt_indices(total_steps)
+        indices = []
+        for i in range(tensor_builder.get_prompt_database_size()):
+            if i not in reachable_indices:
+                indices.append(None)
+                continue
+
+            prompt = tensor_builder.get_prompt(i)
+            if prompt not in flattened_indices:
+                flattened_indices[prompt] = len(flattened_prompts)
+                flattened_prompts.append(prompt)
+            indices.append(flattened_indices[prompt])
+        prompt_indices.append(indices)
+
+    return flattened_prompts, prompt_indices
+
+
+def _sample_tensor_schedules(tensor, steps, origin_schedules):
+    slerp_scale = global_state.get_slerp_scale()
+    leaf_schedules = tensor.get_leaf_schedules()
+    if leaf_schedules and (slerp_scale == 0 or origin_schedules is None):
+        return lazy_schedule.StaticConditioningSchedule(leaf_schedules)
+
+    slerp_epsilon = global_state.get_slerp_epsilon()
+    params_at_steps = [
+        interpolation_tensor.InterpolationParams(step / steps, step, steps, slerp_scale, slerp_epsilon)
+        for step in range(steps)
+    ]
 
-    for step in range(steps):
-        origin_cond = global_state.get_origin_cond_at(step, is_hires)
-        params = interpolation_tensor.InterpolationParams(step / steps, step, steps, global_state.get_slerp_scale(), global_state.get_slerp_epsilon())
-        schedule_cond = tensor.interpolate(params, origin_cond, empty_cond.get())
-        if schedules and schedules[-1].cond == schedule_cond:
-            schedules[-1] = prompt_parser.ScheduledPromptConditioning(end_at_step=step, cond=schedules[-1].cond)
-        else:
-            schedules.append(prompt_parser.ScheduledPromptConditioning(end_at_step=step, cond=schedule_cond))
+    change_steps = tensor.get_change_steps(params_at_steps)
+    if slerp_scale != 0:
+        change_steps |= {schedule.end_at_step + 1 for schedule in origin_schedules or ()}
+    change_steps = sorted(step for step in change_steps if 0 < step < steps)
+    intervals = [
+        (begin_step, end_step)
+        for begin_step, end_step in zip([0] + change_steps, change_steps + [steps])
+        if begin_step < end_step
+    ]
 
-    return schedules
+    return lazy_schedule.LazyConditioningSchedule(tensor, intervals, params_at_steps, origin_schedules, empty_cond.get(), global_state.get_lazy_schedule_cache_size())
 
 
 class PromptFusionScript(scripts.Script):
@@ -141,5 +431,14 @@ class PromptFusionScript(scripts.Script):
         return scripts.AlwaysVisible
 
     def process(self, p, *args):
-        global_state.negative_schedules = None
-        global_state.old_webui_is_negative = True
+        context = fusion_context.begin()
+        context.old_webui_is_negative = True
+
+    def process_batch(self, p, *args, **kwargs):
+        context = fusion_context.get()
+        context.request_conds = {}
+        extra_network_data = getattr(p, 'extra_network_data', None) or {}
+        context.extra_network_key = tuple(
+            (name, tuple(tuple(params.items) for params in params_list))
+            for name, params_list in sorted(extra_network_data.items())
+        )
@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import types
+import torch
+from lib_prompt_fusion import empty_cond, fusion_context, global_state
+from modules import shared
+
+
+class _Embedding:
+    def __init__(self, embedding_hash):
+        self.__hash = embedding_hash
+        self.hash_reads = 0
+
+    @property
+    def hash(self):
+        self.hash_reads += 1
+        return self.__hash
+
+
+def run_embeddings_fingerprint_tests():
+    sd_hijack = types.ModuleType('modules.sd_hijack')
+    sd_hijack.model_hijack = types.SimpleNamespace(embedding_db=types.SimpleNamespace(word_embeddings={'style': _Embedding('aaaa')}))
+    sys.modules['modules.sd_hijack'] = sd_hijack
+    try:
+        before = global_state.get_embeddings_fingerprint()
+        assert global_state.get_embeddings_fingerprint() == before
+        assert sd_hijack.model_hijack.embedding_db.word_embeddings['style'].hash_reads == 1, 'unchanged embeddings should not be fingerprinted again'
+
+        sd_hijack.model_hijack.embedding_db.word_embeddings['style'] = _Embedding('bbbb')
+        assert global_state.get_embeddings_fingerprint() != before, 'replacing an embedding should change the cache key'
+    finally:
+        del sys.modules['modules.sd_hijack']
+
+
+def run_networks_fingerprint_tests():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'detail.pt')
+        with open(path, 'wb') as network_file:
+            network_file.write(b'0' * 8)
+
+        shared.hypernetworks = {'detail': path}
+        try:
+            extra_network_key = (('hypernet', (('detail', '1'),)),)
+            before = global_state.get_networks_fingerprint(extra_network_key)
+            with open(path, 'wb') as network_file:
+                network_file.write(b'0' * 16)
+            assert global_state.get_networks_fingerprint(extra_network_key) != before, 'replacing a network file should change the cache key'
+        finally:
+            del shared.hypernetworks
+
+
+class _Model:
+    def __init__(self):
+        self.encoded_prompts = []
+
+    def get_learned_conditioning(self, prompts):
+        self.encoded_prompts.extend(prompts)
+        return torch.zeros(len(prompts), 77, 8)
+
+
+def run_empty_cond_tests():
+    model = _Model()
+    context = fusion_context.begin()
+
+    empty_cond.init(model)
+    empty_cond.init(model)
+    assert len(model.encoded_prompts) == 1, 'the empty cond should be reused while the active networks stay the same'
+
+    context.extra_network_key = (('lora', (('detail', '1'),)),)
+    empty_cond.init(model)
+    assert len(model.encoded_prompts) == 2, 'activating a network should re-encode the empty cond'
+
+    context.extra_network_key = (('lora', (('detail', '0.5'),)),)
+    empty_cond.init(model)
+    assert len(model.encoded_prompts) == 3, 'changing a network multiplier should re-encode the empty cond'
+
+
+def run_tests():
+    run_embeddings_fingerprint_tests()
+    run_networks_fingerprint_tests()
+    run_empty_cond_tests()
@@ -0,0 +1,177 @@
+import hashlib
+import importlib.util
+import os
+import threading
+import torch
+from lib_prompt_fusion import fusion_context, global_state
+from modules import prompt_parser, shared
+
+
+class _Prompts(list):
+    pass
+
+
+class _Model:
+    def get_learned_conditioning(self, prompts):
+        return torch.stack([_encode(prompt) for prompt in prompts])
+
+
+def _encode(prompt):
+    generator = torch.Generator().manual_seed(int(hashlib.md5(prompt.encode()).hexdigest()[:8], 16))
+    return torch.randn(77, 8, generator=generator)
+
+
+def _original_function(model, prompts, steps, *args, **kwargs):
+    return [[prompt_parser.ScheduledPromptConditioning(end_at_step=steps, cond=_encode(prompt))] for prompt in prompts]
+
+
+def _load_promptlang():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'promptlang.py')
+    spec = importlib.util.spec_from_file_location('promptlang', path)
+    promptlang = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(promptlang)
+    promptlang.on_ui_settings()
+    return promptlang
+
+
+def _generate(promptlang, model, negative_prompt, prompt):
+    promptlang.PromptFusionScript().process(None)
+
+    negative_prompts = _Prompts([negative_prompt])
+    negative_prompts.is_negative_prompt = True
+    promptlang._hijacked_get_learned_conditioning(model, negative_prompts, 20, None, False, original_function=_original_function)
+
+    prompts = _Prompts([prompt])
+    prompts.is_negative_prompt = False
+    schedules = promptlang._hijacked_get_learned_conditioning(model, prompts, 20, None, False, original_function=_original_function)[0]
+    return [(schedule.end_at_step, schedule.cond.clone()) for schedule in schedules]
+
+
+def run_stress_tests():
+    promptlang = _load_promptlang()
+    previous_options = shared.opts.data.copy()
+    shared.opts.data.update(
+        prompt_fusion_enabled=True,
+        prompt_fusion_slerp_scale=0.5,
+        prompt_fusion_slerp_negative_origin=True,
+        prompt_fusion_schedule_cache_size=0,
+    )
+
+    try:
+        model = _Model()
+        requests = [(f'negative [ugly:blurry:,] {i}', f'[a cat:a dog:,] number {i}') for i in range(8)]
+        expected = [_generate(promptlang, model, negative_prompt, prompt) for negative_prompt, prompt in requests]
+
+        barrier = threading.Barrier(len(requests))
+        failures = []
+
+        def run_request(i):
+            barrier.wait()
+            for _ in range(10):
+                actual = _generate(promptlang, model, *requests[i])
+                if [end for end, _ in actual] != [end for end, _ in expected[i]] or not all(torch.equal(a, e) for (_, a), (_, e) in zip(actual, expected[i])):
+                    failures.append(i)
+
+        threads = [threading.Thread(target=run_request, args=(i,)) for i in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not failures, f'concurrent requests read each other\'s state: {sorted(set(failures))}'
+    finally:
+        shared.opts.data.clear()
+        shared.opts.data.update(previous_options)
+
+
+def run_request_conds_scope_tests():
+    promptlang = _load_promptlang()
+    previous_options = shared.opts.data.copy()
+    shared.opts.data.update(prompt_fusion_enabled=True, prompt_fusion_schedule_cache_size=0)
+
+    try:
+        model = _Model()
+        script = promptlang.PromptFusionScript()
+        script.process(None)
+        batch_texts = []
+        for i in range(3):
+            script.process_batch(None)
+            prompts = _Prompts([f'[a cat:a dog:,] batch {i}'])
+            prompts.is_negative_prompt = False
+            promptlang._hijacked_get_learned_conditioning(model, prompts, 20, None, False, original_function=_original_function)
+            promptlang._hijacked_get_learned_conditioning(model, prompts, 10, 20, False, original_function=_original_function)
+            batch_texts.append({text for _, text in fusion_context.get().request_conds})
+
+        assert batch_texts[0] and all(len(texts) == len(batch_texts[0]) for texts in batch_texts), batch_texts
+        assert not batch_texts[2] & (batch_texts[0] | batch_texts[1]), 'later batches should not keep conds of earlier batches'
+    finally:
+        shared.opts.data.clear()
+        shared.opts.data.update(previous_options)
+
+
+def run_mismatched_schedule_tests():
+    promptlang = _load_promptlang()
+    fusion_context.begin()
+    encoded_batches = []
+
+    def original_function(model, prompts, steps, *args, **kwargs):
+        encoded_batches.append(list(prompts))
+        return [
+            [
+                prompt_parser.ScheduledPromptConditioning(end_at_step=steps // 2, cond=_encode(f'{prompt} early')),
+                prompt_parser.ScheduledPromptConditioning(end_at_step=steps, cond=_encode(prompt)),
+            ]
+            if prompt.startswith('mismatched') else
+            [prompt_parser.ScheduledPromptConditioning(end_at_step=steps, cond=_encode(prompt))]
+            for prompt in prompts
+        ]
+
+    model = _Model()
+    promptlang._encode_prompts(model, ['a cat', 'a dog'], 20, (None, False), {}, original_function)
+    schedules = promptlang._encode_prompts(model, ['a cat', 'mismatched prompt', 'a dog'], 20, (None, False), {}, original_function)
+
+    assert encoded_batches == [['a cat', 'a dog'], ['mismatched prompt']], f'only the missing prompt should be encoded again, got {encoded_batches}'
+    assert [len(schedule) for schedule in schedules] == [1, 2, 1]
+    assert torch.equal(schedules[0][0].cond, _encode('a cat')) and torch.equal(schedules[2][0].cond, _encode('a dog'))
+    assert torch.equal(schedules[1][0].cond, _encode('mismatched prompt early')), 'prompts the webui schedules differently should keep its encoding'
+
+
+def run_schedule_cache_tests():
+    promptlang = _load_promptlang()
+    previous_options = shared.opts.data.copy()
+
+    try:
+        for slerp_scale in (0, 0.5):
+            shared.opts.data.update(
+                prompt_fusion_enabled=True,
+                prompt_fusion_slerp_scale=slerp_scale,
+                prompt_fusion_schedule_cache_size=256,
+                prompt_fusion_instrumentation_enabled=True,
+            )
+            global_state.schedule_cache.clear()
+            model = _Model()
+            request = (f'negative [ugly:blurry:,] {slerp_scale}', f'[a cat:a dog:,] cached {slerp_scale}')
+
+            global_state.phase_recorder.clear()
+            first = _generate(promptlang, model, *request)
+            first_phases = [record.name for record in global_state.phase_recorder.records()]
+            assert 'encode' in first_phases and 'interpolate' in first_phases, first_phases
+
+            global_state.phase_recorder.clear()
+            second = _generate(promptlang, model, *request)
+            second_phases = [record.name for record in global_state.phase_recorder.records()]
+            assert 'encode' not in second_phases and 'interpolate' not in second_phases, f'slerp {slerp_scale}: a repeated generation should skip encoding and interpolation, got {second_phases}'
+            assert all(a_end == b_end and torch.equal(a, b) for (a_end, a), (b_end, b) in zip(first, second))
+    finally:
+        global_state.schedule_cache.clear()
+        global_state.phase_recorder.clear()
+        shared.opts.data.clear()
+        shared.opts.data.update(previous_options)
+        global_state.phase_recorder.configure(global_state.get_instrumentation_enabled(), global_state.get_instrumentation_buffer_size())
+
+
+def run_tests():
+    run_stress_tests()
+    run_request_conds_scope_tests()
+    run_mismatched_schedule_tests()
+    run_schedule_cache_tests()
@@ -0,0 +1,76 @@
+import importlib.util
+import os
+from lib_prompt_fusion.cost_estimator import estimate_chunk_count, explain_prompt
+from lib_prompt_fusion.prompt_plan import UnknownSymbolError
+
+try:
+    import fastapi
+    import fastapi.testclient
+except ImportError:
+    fastapi = None
+
+
+def run_explain_tests():
+    cost = explain_prompt('a photo of a cat', 20)
+    assert (cost.flattened_prompts, cost.encoded_chunks, cost.max_chunks, cost.distinct_conds) == (1, 1, 1, 1), cost
+    assert cost.peak_bytes == {'crossattn': 77 * 768 * 4}, cost.peak_bytes
+    assert cost.interpolation_tree == 0
+
+    cost = explain_prompt('[[a:b:,]:[c:d:,]:,]', 20, model_type='sdxl')
+    assert (cost.flattened_prompts, cost.distinct_conds) == (4, 20), cost
+    assert set(cost.peak_bytes) == {'crossattn', 'vector'}
+    assert cost.interpolation_tree == {'function': 'linear', 'children': [
+        {'function': 'linear', 'children': [0, 1]},
+        {'function': 'linear', 'children': [2, 3]},
+    ]}, cost.interpolation_tree
+
+    cost = explain_prompt('[a:b:c:,,] ' + 'word ' * 100, 10)
+    assert (cost.encoded_chunks, cost.max_chunks) == (6, 2), cost
+
+    cost = explain_prompt('[a|b|c:2]', 12)
+    assert cost.interpolation_tree['function'] == 'wrap'
+
+
+def run_chunk_tests():
+    assert estimate_chunk_count('') == 1
+    assert estimate_chunk_count('word ' * 75) == 1
+    assert estimate_chunk_count('word ' * 76) == 2
+    assert estimate_chunk_count('(a:1.2) BREAK b') == 2
+
+
+def run_unknown_symbol_tests():
+    for prompt in ('$undefined cat', '[a:b:$x,3]', '(a:$w,2)'):
+        try:
+            explain_prompt(prompt, 20)
+        except UnknownSymbolError:
+            continue
+        raise AssertionError(f'{prompt!r} should raise UnknownSymbolError')
+
+
+def run_explain_route_tests():
+    if fastapi is None:
+        return
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'promptlang.py')
+    spec = importlib.util.spec_from_file_location('promptlang', path)
+    promptlang = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(promptlang)
+
+    app = fastapi.FastAPI()
+    promptlang.on_app_started(None, app)
+    client = fastapi.testclient.TestClient(app)
+
+    response = client.post('/prompt-fusion/explain', json={'prompt': '[a:b:,]', 'steps': 10})
+    assert response.status_code == 200, response.text
+    assert response.json()['flattened_prompts'] == 2
+
+    for prompt in ('$undefined cat', '[a:b:$x,3]', '(a:$w,2)', '$a = $a\n$a'):
+        response = client.post('/prompt-fusion/explain', json={'prompt': prompt, 'steps': 10})
+        assert response.status_code == 422, f'{prompt!r}: {response.status_code} {response.text}'
+
+
+def run_tests():
+    run_explain_tests()
+    run_chunk_tests()
+    run_unknown_symbol_tests()
+    run_explain_route_tests()
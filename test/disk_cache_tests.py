@@ -0,0 +1,147 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import torch
+from modules import prompt_parser
+from lib_prompt_fusion import disk_cache
+
+
+def _create_schedules(prompt):
+    generator = torch.Generator().manual_seed(len(prompt))
+    return [
+        prompt_parser.ScheduledPromptConditioning(cond=torch.randn(77, 16, generator=generator), end_at_step=4),
+        prompt_parser.ScheduledPromptConditioning(cond={
+            'crossattn': torch.randn(154, 16, generator=generator).half(),
+            'vector': torch.randn(32, generator=generator),
+        }, end_at_step=9),
+    ]
+
+
+def _describe_mismatch(actual, expected):
+    if actual is None:
+        return 'missing'
+    if [schedule.end_at_step for schedule in actual] != [schedule.end_at_step for schedule in expected]:
+        return 'end_at_step'
+    if not torch.equal(actual[0].cond, expected[0].cond):
+        return 'cond'
+    if not all(actual[1].cond[k].dtype == v.dtype and torch.equal(actual[1].cond[k], v) for k, v in expected[1].cond.items()):
+        return 'dict cond'
+
+    return None
+
+
+def _put_in_worker(directory, prompts):
+    cache = disk_cache.DiskConditioningCache()
+    cache.configure(directory, 1024 * 1024)
+    for prompt in prompts:
+        cache.put(prompt, _create_schedules(prompt))
+        cache.get(prompt, 'cpu')
+    cache.flush()
+
+
+def _get_entry_paths(directory):
+    return [name for name in os.listdir(directory) if name.endswith('.safetensors')]
+
+
+def run_round_trip_tests():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = disk_cache.DiskConditioningCache()
+        cache.configure(directory, 1024 * 1024)
+        prompts = ['a cat', 'a dog wearing a hat']
+        for prompt in prompts:
+            cache.put(prompt, _create_schedules(prompt))
+
+        for prompt in prompts:
+            assert _describe_mismatch(cache.get(prompt, 'cpu'), _create_schedules(prompt)) is None, prompt
+        assert cache.get('missing', 'cpu') is None
+
+        cond = cache.get('a cat', 'cpu')[0].cond
+        entry_size = os.path.getsize(os.path.join(directory, f'{disk_cache._get_digest("a cat")}.safetensors'))
+        assert cond.untyped_storage().nbytes() == entry_size, 'cpu loads should be views of the mapped entry file'
+
+
+def run_eviction_tests():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = disk_cache.DiskConditioningCache()
+        cache.configure(directory, 24 * 1024)
+        for prompt in ['a', 'bb']:
+            cache.put(prompt, _create_schedules(prompt))
+        assert cache.get('a', 'cpu') is not None
+        cache.put('ccc', _create_schedules('ccc'))
+
+        assert cache.get('bb', 'cpu') is None, 'least recently used entry should be evicted first'
+        assert cache.get('a', 'cpu') is not None and cache.get('ccc', 'cpu') is not None
+        assert len(_get_entry_paths(directory)) == 2
+        assert sum(os.path.getsize(os.path.join(directory, path)) for path in _get_entry_paths(directory)) <= 24 * 1024
+
+
+def run_restart_tests():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = disk_cache.DiskConditioningCache()
+        cache.configure(directory, 1024 * 1024)
+        cache.put('a cat', _create_schedules('a cat'))
+        cache.flush()
+
+        restarted_cache = disk_cache.DiskConditioningCache()
+        restarted_cache.configure(directory, 1024 * 1024)
+        assert _describe_mismatch(restarted_cache.get('a cat', 'cpu'), _create_schedules('a cat')) is None
+
+
+def run_damaged_file_tests():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = disk_cache.DiskConditioningCache()
+        cache.configure(directory, 1024 * 1024)
+        cache.put('corrupt', _create_schedules('corrupt'))
+        cache.put('missing', _create_schedules('missing'))
+        cache.flush()
+        corrupt_path, missing_path = (
+            os.path.join(directory, f'{disk_cache._get_digest(prompt)}.safetensors')
+            for prompt in ('corrupt', 'missing')
+        )
+
+        os.remove(missing_path)
+        assert cache.get('missing', 'cpu') is None
+
+        for corrupt_content in (b'', b'abc', b'not a safetensors file', b'\x02\x00\x00\x00\x00\x00\x00\x00[]'):
+            with open(corrupt_path, 'wb') as corrupt_file:
+                corrupt_file.write(corrupt_content)
+            assert cache.get('corrupt', 'cpu') is None, corrupt_content
+
+        cache.put('corrupt', _create_schedules('corrupt'))
+        assert _describe_mismatch(cache.get('corrupt', 'cpu'), _create_schedules('corrupt')) is None, 'a damaged entry should be replaceable'
+
+
+def run_shared_directory_tests():
+    with tempfile.TemporaryDirectory() as directory:
+        workers_prompts = [[f'worker {i} prompt {j}' for j in range(5)] for i in range(4)]
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=_put_in_worker, args=(directory, prompts)) for prompts in workers_prompts]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+
+        with open(os.path.join(directory, disk_cache.DiskConditioningCache.index_file_name)) as index_file:
+            index = json.load(index_file)
+        expected_digests = {disk_cache._get_digest(prompt) for prompts in workers_prompts for prompt in prompts}
+        assert set(index) == expected_digests, f'{len(expected_digests - set(index))} entries written by other instances were lost'
+
+        cache = disk_cache.DiskConditioningCache()
+        cache.configure(directory, 1024 * 1024)
+        cache.configure(directory, 24 * 1024)
+        with open(os.path.join(directory, disk_cache.DiskConditioningCache.index_file_name)) as index_file:
+            index = json.load(index_file)
+        assert len(index) == 2 and len(_get_entry_paths(directory)) == 2, 'shrinking the budget should evict entries of every instance'
+
+
+def run_tests():
+    if disk_cache.safetensors is None:
+        return
+
+    run_round_trip_tests()
+    run_eviction_tests()
+    run_restart_tests()
+    run_damaged_file_tests()
+    run_shared_directory_tests()
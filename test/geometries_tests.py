@@ -0,0 +1,60 @@
+import math
+import torch
+from lib_prompt_fusion.geometries import slerp_geometry
+from lib_prompt_fusion.interpolation_tensor import InterpolationParams
+
+
+def run_batched_slerp_tests():
+    generator = torch.Generator().manual_seed(0)
+    p0 = torch.randn(77, 8, generator=generator)
+    p1 = torch.randn(77, 8, generator=generator)
+    ts = torch.linspace(0, 1, 5)
+
+    for points in ([p0, p1], [p0, p0 * 2]):
+        batched = slerp_geometry(points, InterpolationParams(ts, 0, 5, 1., 0.0001))
+        assert batched.shape == (5, 77, 8)
+        for i, t in enumerate(ts.tolist()):
+            single = slerp_geometry(points, InterpolationParams(t, 0, 5, 1., 0.0001))
+            assert torch.allclose(batched[i], single, atol=1e-5), f'batched slerp differs at t={t}'
+
+        assert torch.allclose(batched[0], points[0], atol=1e-5)
+        assert torch.allclose(batched[-1], points[1], atol=1e-5)
+
+
+def run_reference_slerp_tests():
+    generator = torch.Generator().manual_seed(1)
+    p0 = torch.randn(77, 8, generator=generator)
+    p1 = torch.randn(77, 8, generator=generator)
+    zero = torch.zeros(77, 8)
+
+    for points in ([p0, p1], [p0, p0 * 2], [p0, -p0], [zero, p1], [p0, zero], [zero, zero]):
+        for t in (0., 0.3, 0.5, 1.):
+            params = InterpolationParams(t, 0, 5, 0.7, 0.0001)
+            actual = slerp_geometry(points, params)
+            expected = reference_slerp_geometry(points, params)
+            assert torch.isfinite(actual).all(), f'slerp produced non-finite values at t={t}'
+            assert torch.allclose(actual, expected, atol=1e-5), f'slerp differs from the reference at t={t}'
+
+
+def reference_slerp_geometry(control_points, params):
+    p0, p1 = control_points
+    p0_norm = torch.linalg.norm(p0)
+    p1_norm = torch.linalg.norm(p1)
+    lerp_p = p0 + (p1 - p0) * params.t
+
+    similarity = torch.sum((p0 / p0_norm) * (p1 / p1_norm))
+    similarity = min(1., max(-1., float(similarity)))
+    if similarity <= params.slerp_epsilon - 1 or similarity >= 1 - params.slerp_epsilon:
+        return lerp_p
+
+    angle = math.acos(similarity) / 2
+    slerp_t = (math.tan(angle * (2 * params.t - 1)) / math.tan(angle) + 1) / 2
+    slerp_p = p0 + (p1 / p1_norm * p0_norm - p0) * slerp_t
+    slerp_p = slerp_p / torch.linalg.norm(slerp_p) * (p0_norm + (p1_norm - p0_norm) * params.t)
+    return lerp_p + (slerp_p - lerp_p) * params.slerp_scale
+
+
+def run_tests():
+    run_batched_slerp_tests()
+    run_reference_slerp_tests()
+
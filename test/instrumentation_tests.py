@@ -0,0 +1,26 @@
+from lib_prompt_fusion.instrumentation import PhaseRecorder
+
+
+def run_recorder_tests():
+    recorder = PhaseRecorder(capacity=2)
+    with recorder.phase('parse', prompts=1):
+        pass
+    assert recorder.records() == [], 'a disabled recorder should not record anything'
+
+    recorder.configure(enabled=True, capacity=2)
+    for i in range(3):
+        with recorder.phase('parse', prompts=1) as phase:
+            phase.set(leaves=i)
+    assert [record.counts['leaves'] for record in recorder.records()] == [1, 2], 'the oldest records should be dropped first'
+    assert recorder.stats()['parse']['calls'] == 2
+    assert recorder.stats()['parse']['counts'] == {'prompts': 2, 'leaves': 3}
+
+    events = recorder.chrome_trace()['traceEvents']
+    assert [event['name'] for event in events] == ['parse', 'parse'] and all(event['ph'] == 'X' for event in events)
+
+    recorder.clear()
+    assert recorder.records() == []
+
+
+def run_tests():
+    run_recorder_tests()
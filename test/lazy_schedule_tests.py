@@ -0,0 +1,96 @@
+import hashlib
+import pickle
+import torch
+from lib_prompt_fusion.interpolation_tensor import InterpolationParams, TensorCondWrapper
+from lib_prompt_fusion.lazy_schedule import LazyConditioningSchedule, max_batched_intervals
+from lib_prompt_fusion.prompt_parser import parse_prompt
+from lib_prompt_fusion.prompt_plan import compile_prompt
+from modules import prompt_parser
+
+
+def _encode(prompt):
+    generator = torch.Generator().manual_seed(int(hashlib.md5(prompt.encode()).hexdigest()[:8], 16))
+    return TensorCondWrapper(torch.randn(77, 8, generator=generator))
+
+
+def build_tensor(prompt, total_steps):
+    tensor_builder = compile_prompt(parse_prompt(prompt)).bind(total_steps, is_hires=False, use_old_scheduling=False)
+    conds = [
+        [prompt_parser.ScheduledPromptConditioning(end_at_step=total_steps, cond=_encode(tensor_builder.get_prompt(i)))]
+        for i in range(tensor_builder.get_prompt_database_size())
+    ]
+    empty_cond = TensorCondWrapper(torch.zeros(77, 8), resources={})
+    return tensor_builder.build(conds, empty_cond), empty_cond
+
+
+def build_schedule(prompt, total_steps, slerp_scale=0., **kwargs):
+    tensor, empty_cond = build_tensor(prompt, total_steps)
+    params_at_steps = [InterpolationParams(step / total_steps, step, total_steps, slerp_scale, 0.0001) for step in range(total_steps)]
+    change_steps = sorted(step for step in tensor.get_change_steps(params_at_steps) if 0 < step < total_steps)
+    intervals = list(zip([0] + change_steps, change_steps + [total_steps]))
+    return LazyConditioningSchedule(tensor, intervals, params_at_steps, None, empty_cond, **kwargs), tensor, intervals, params_at_steps, empty_cond
+
+
+def count_contractions(tensor):
+    calls = []
+    interpolate_linear_combinations = tensor.interpolate_linear_combinations
+
+    def counting_interpolate_linear_combinations(params_list, *args):
+        calls.append(len(params_list))
+        return interpolate_linear_combinations(params_list, *args)
+
+    tensor.interpolate_linear_combinations = counting_interpolate_linear_combinations
+    return calls
+
+
+def run_batched_tests():
+    for prompt, total_steps, expected_batched in (
+        ('[a:b:0,4]', 20, True),
+        ('[a:b:,]', 20, False),
+    ):
+        schedule, tensor, intervals, params_at_steps, empty_cond = build_schedule(prompt, total_steps)
+        calls = count_contractions(tensor)
+        schedules = schedule.get_schedules()
+        assert (len(schedules) <= max_batched_intervals) == expected_batched, len(schedules)
+
+        for lazy_schedule, (begin_step, _) in list(zip(schedules, intervals)) * 2:
+            expected = tensor.interpolate(params_at_steps[begin_step], empty_cond, empty_cond)
+            assert torch.allclose(lazy_schedule.cond.original_cond, expected.original_cond, atol=1e-6), (prompt, lazy_schedule.end_at_step)
+
+        if expected_batched:
+            assert calls == [len(schedules)], f'{prompt!r}: every interval should come from one contraction, got {calls}'
+        else:
+            assert len(calls) == 2 * len(schedules), f'{prompt!r}: long schedules should stay lazy, got {len(calls)} contractions'
+
+
+def run_scheduled_prompt_conditioning_tests():
+    schedule, *_ = build_schedule('[a:b:0,4]', 20)
+    lazy_schedule = schedule.get_schedules(unwrap=True)[-1]
+    assert isinstance(lazy_schedule, prompt_parser.ScheduledPromptConditioning)
+
+    end_at_step, cond = lazy_schedule
+    assert end_at_step == lazy_schedule[0] == lazy_schedule.end_at_step
+    assert torch.equal(cond, lazy_schedule[1]) and torch.equal(cond, lazy_schedule.cond)
+
+    replaced = lazy_schedule._replace(end_at_step=end_at_step + 1)
+    assert type(replaced) is prompt_parser.ScheduledPromptConditioning
+    assert replaced.end_at_step == end_at_step + 1 and torch.equal(replaced.cond, cond)
+
+    unpickled = pickle.loads(pickle.dumps(lazy_schedule))
+    assert type(unpickled) is prompt_parser.ScheduledPromptConditioning and torch.equal(unpickled.cond, cond)
+
+
+def run_cache_size_tests():
+    for cache_size, expected_contractions in ((2, 3 * 20), (20, 20)):
+        schedule, tensor, *_ = build_schedule('[a:b:,]', 20, cache_size=cache_size)
+        calls = count_contractions(tensor)
+        schedules = schedule.get_schedules()
+        for lazy_schedule in schedules * 3:
+            lazy_schedule.cond
+        assert len(calls) == expected_contractions, (cache_size, len(calls))
+
+
+def run_tests():
+    run_batched_tests()
+    run_scheduled_prompt_conditioning_tests()
+    run_cache_size_tests()
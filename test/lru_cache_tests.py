@@ -0,0 +1,48 @@
+from lib_prompt_fusion.lru_cache import LruCache
+
+
+def run_eviction_tests():
+    cache = LruCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'b' not in cache, 'least recently used entry should be evicted first'
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'entries': 2, 'bytes': 0, 'hits': 3, 'misses': 0, 'evictions': 1}, cache.stats()
+
+
+def run_byte_budget_tests():
+    cache = LruCache(max_bytes=10, size_of=lambda key, _value: len(key))
+    cache.put('aaaa', 1)
+    cache.put('bbbb', 2)
+    cache.put('cccc', 3)
+    assert 'aaaa' not in cache and len(cache) == 2
+    cache.put('d' * 11, 4)
+    assert 'd' * 11 not in cache, 'entries larger than the whole budget should not be cached'
+    cache.resize(max_bytes=4)
+    assert len(cache) == 1 and 'cccc' in cache
+
+
+def run_get_or_create_tests():
+    calls = []
+
+    def create():
+        calls.append(None)
+        return 'parsed'
+
+    cache = LruCache(max_entries=8)
+    for _ in range(64):
+        assert cache.get_or_create('prompt', create) == 'parsed'
+    assert len(calls) == 1
+    assert cache.hits == 63 and cache.misses == 1
+
+    disabled_cache = LruCache(max_entries=0)
+    disabled_cache.get_or_create('prompt', create)
+    assert len(disabled_cache) == 0
+
+
+def run_tests():
+    run_eviction_tests()
+    run_byte_budget_tests()
+    run_get_or_create_tests()
@@ -1,5 +1,9 @@
-from lib_prompt_fusion.prompt_parser import parse_prompt
+import time
+from lib_prompt_fusion.prompt_parser import is_plain_prompt, parse_prompt
 from lib_prompt_fusion.interpolation_tensor import InterpolationTensorBuilder
+from lib_prompt_fusion.prompt_plan import compile_prompt
+from lib_prompt_fusion import interpolation_functions
+from lib_prompt_fusion.interpolation_tensor import InterpolationParams
 
 
 def run_functional_tests(total_steps=100):
@@ -100,5 +104,88 @@ functional_parse_test_cases = [
 ]
 
 
+def run_attention_interpolation_tests(total_steps=150):
+    for given, points, expected in attention_interpolation_test_cases:
+        plan = compile_prompt(parse_prompt(given))
+        actual = plan.bind(total_steps, is_hires=False, use_old_scheduling=False, attention_interpolation_points=points).get_prompt_database()
+        assert actual == expected, f"{actual} != {expected}"
+
+
+attention_interpolation_test_cases = [
+    ('(fire extinguisher: 1.0, 2.0)', 2, ['(fire extinguisher:1.0)', '(fire extinguisher:2.0)']),
+    ('(fire extinguisher: 1.0, 2.0)', 3, ['(fire extinguisher:1.0)', '(fire extinguisher:1.5)', '(fire extinguisher:2.0)']),
+    ('(fire extinguisher: 1.5, 1.5)', 3, ['(fire extinguisher:1.5)']),
+    ('[(fire extinguisher: 1, 2)::5]', 2, ['[(fire extinguisher:1.0)::5]', '[(fire extinguisher:2.0)::5]']),
+]
+
+
+def run_plain_prompt_tests():
+    for given, expected in plain_prompt_test_cases:
+        actual = is_plain_prompt(given)
+        assert actual == expected, f"{given!r}: {actual} != {expected}"
+
+    long_prompt = '(masterpiece: best quality) ' * 2500
+    start = time.perf_counter()
+    assert is_plain_prompt(long_prompt)
+    scan_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    parse_prompt(long_prompt)
+    parse_seconds = time.perf_counter() - start
+    assert scan_seconds < parse_seconds, f'plain prompt scan took {scan_seconds:.3f}s, parsing took {parse_seconds:.3f}s'
+
+
+plain_prompt_test_cases = [
+    ('a photo of a cat', True),
+    ('(masterpiece, best quality:1.2), (cat), 1girl', True),
+    ('time: 12:30, place: home', False),
+    ('[a:b:5]', False),
+    ('[a|b]', False),
+    ('$a = cat\n$a', False),
+    ('(fire extinguisher: 1.0, 2.0)', False),
+    ('(fire extinguisher:.5,2)', False),
+]
+
+
+def run_plan_size_tests():
+    small_plan = compile_prompt(parse_prompt('a cat'))
+    large_plan = compile_prompt(parse_prompt(' '.join(f'[word{i}:other{i}:,]' for i in range(100))))
+    assert 0 < small_plan.get_nbytes() < large_plan.get_nbytes()
+    assert large_plan.get_nbytes() > sum(len(fragment) for fragment in large_plan.fragments)
+
+
+def run_reachable_prompt_tests(total_steps=20):
+    def get_reachable_prompts(prompt):
+        tensor_builder = compile_prompt(parse_prompt(prompt)).bind(total_steps, is_hires=False, use_old_scheduling=False)
+        return tensor_builder.get_prompt_database_size(), {tensor_builder.get_prompt(i) for i in tensor_builder.get_reachable_prompt_indices(total_steps)}
+
+    size, reachable = get_reachable_prompts('[a:b:0,6] [c:d:7,13] [e:f:14,19]')
+    assert size == 8, size
+    assert reachable == {'a c e', 'b c e', 'b d e', 'b d f'}, reachable
+
+    size, reachable = get_reachable_prompts('[a:b:,] [c:d:,] [e:f:,]')
+    assert size == 8, size
+    assert len(reachable) == 8, reachable
+
+
+def run_segment_table_tests(total_steps=50):
+    for prompt in ('[a:b:c:d:,,,]', '[a:b:c:d:e:,12,20,,]', '[a:b:c:d:e:,,,,:catmull]'):
+        tensor_builder = compile_prompt(parse_prompt(prompt)).bind(total_steps, is_hires=False, use_old_scheduling=False)
+        function, children = tensor_builder.get_interpolation_tree()
+        assert function.segments == [interpolation_functions.get_segment(len(children), t) for t in function.scaled_ts], prompt
+
+        get_segment = interpolation_functions.get_segment
+        interpolation_functions.get_segment = None
+        try:
+            for step in range(total_steps):
+                function.get_active_control_points(len(children), InterpolationParams(step / total_steps, step, total_steps, 0., 0.))
+        finally:
+            interpolation_functions.get_segment = get_segment
+
+
 def run_tests():
     run_functional_tests()
+    run_segment_table_tests()
+    run_plan_size_tests()
+    run_reachable_prompt_tests()
+    run_attention_interpolation_tests()
+    run_plain_prompt_tests()
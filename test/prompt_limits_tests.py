@@ -0,0 +1,56 @@
+from lib_prompt_fusion.prompt_limits import PromptLimits, PromptLimitError, enforce
+from lib_prompt_fusion.prompt_parser import parse_prompt
+from lib_prompt_fusion.prompt_plan import compile_prompt
+
+
+def compile_and_bind(prompt, limits, total_steps=20):
+    with enforce(limits) as limits_guard:
+        plan = compile_prompt(parse_prompt(prompt))
+        limits_guard.check_plan(plan)
+        tensor_builder = plan.bind(total_steps, is_hires=False, use_old_scheduling=False)
+        limits_guard.check_tensor_builder(tensor_builder)
+        return tensor_builder
+
+
+def assert_limit_error(prompt, limits, expected_limit, total_steps=20):
+    try:
+        compile_and_bind(prompt, limits, total_steps)
+    except PromptLimitError as e:
+        assert e.limit == expected_limit, f'{prompt!r}: {e.limit} != {expected_limit}'
+        assert e.to_dict()['limit'] == expected_limit
+        return
+
+    raise AssertionError(f'{prompt!r} should exceed {expected_limit}')
+
+
+def run_limit_tests():
+    assert compile_and_bind('[a:b:c:,,]', PromptLimits(max_prompt_database_size=3)).get_prompt_database_size() == 3
+    assert_limit_error('[[a:b:,]:[c:d:,]:,]', PromptLimits(max_prompt_database_size=3), 'max_prompt_database_size')
+    assert_limit_error('[[[[a::1]::1]::1]::1]', PromptLimits(max_ast_depth=4), 'max_ast_depth')
+    assert_limit_error('$a = x\n$b = $a $a\n$c = $b $b\n$c', PromptLimits(max_substitution_depth=2), 'max_substitution_depth')
+    assert_limit_error('(long prompt: 0, 2)', PromptLimits(max_expanded_characters=1000), 'max_expanded_characters', total_steps=100)
+    assert_limit_error('$a = $a\n$a', PromptLimits(), 'recursion_depth')
+    assert_limit_error('[' * 10000, PromptLimits(), 'recursion_depth')
+
+
+def run_cached_plan_tests():
+    with enforce(PromptLimits()):
+        plan = compile_prompt(parse_prompt('$a = x\n$b = $a $a\n$c = [[$b::1]::1]\n$c'))
+    assert plan.metrics.substitution_depth == 3, plan.metrics
+
+    for limits, expected_limit in (
+        (PromptLimits(max_substitution_depth=2), 'max_substitution_depth'),
+        (PromptLimits(max_ast_depth=4), 'max_ast_depth'),
+    ):
+        try:
+            with enforce(limits) as limits_guard:
+                limits_guard.check_plan(plan)
+        except PromptLimitError as e:
+            assert e.limit == expected_limit, f'{e.limit} != {expected_limit}'
+        else:
+            raise AssertionError(f'a plan compiled under looser limits should still exceed {expected_limit}')
+
+
+def run_tests():
+    run_limit_tests()
+    run_cached_plan_tests()
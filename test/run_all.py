@@ -1,7 +1,31 @@
 import sys
 sys.path.append('..')
+try:
+    import modules
+except ImportError:
+    sys.path.append('stubs')
 import parser_tests
+import lru_cache_tests
+import geometries_tests
+import shared_memory_cache_tests
+import disk_cache_tests
+import prompt_limits_tests
+import cost_estimator_tests
+import instrumentation_tests
+import cache_key_tests
+import lazy_schedule_tests
+import concurrency_tests
 
 
 if __name__ == '__main__':
     parser_tests.run_tests()
+    lru_cache_tests.run_tests()
+    geometries_tests.run_tests()
+    shared_memory_cache_tests.run_tests()
+    disk_cache_tests.run_tests()
+    prompt_limits_tests.run_tests()
+    cost_estimator_tests.run_tests()
+    instrumentation_tests.run_tests()
+    cache_key_tests.run_tests()
+    lazy_schedule_tests.run_tests()
+    concurrency_tests.run_tests()
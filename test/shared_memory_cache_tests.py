@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import torch
+from modules import prompt_parser
+from lib_prompt_fusion import shared_memory_cache
+
+
+def _create_schedules(prompt):
+    generator = torch.Generator().manual_seed(len(prompt))
+    return [
+        prompt_parser.ScheduledPromptConditioning(cond=torch.randn(77, 16, generator=generator), end_at_step=4),
+        prompt_parser.ScheduledPromptConditioning(cond={
+            'crossattn': torch.randn(154, 16, generator=generator).half(),
+            'vector': torch.randn(32, generator=generator),
+        }, end_at_step=9),
+    ]
+
+
+def _put_in_worker(name, prompt):
+    cache = shared_memory_cache.SharedMemoryConditioningCache()
+    cache.configure(name, 1024 * 1024)
+    cache.put(prompt, _create_schedules(prompt))
+
+
+def _get_in_worker(name, prompts, results):
+    cache = shared_memory_cache.SharedMemoryConditioningCache()
+    cache.configure(name, 1024 * 1024)
+    for prompt in prompts:
+        results.put((prompt, _describe_mismatch(cache.get(prompt, 'cpu'), _create_schedules(prompt))))
+
+
+def _describe_mismatch(actual, expected):
+    if actual is None:
+        return 'missing'
+    if [schedule.end_at_step for schedule in actual] != [schedule.end_at_step for schedule in expected]:
+        return 'end_at_step'
+    if not torch.equal(actual[0].cond, expected[0].cond):
+        return 'cond'
+    if not all(actual[1].cond[k].dtype == v.dtype and torch.equal(actual[1].cond[k], v) for k, v in expected[1].cond.items()):
+        return 'dict cond'
+
+    return None
+
+
+def run_cross_process_tests():
+    if shared_memory_cache.fcntl is None:
+        return
+
+    name = f'prompt_fusion_test_{os.getpid()}'
+    prompts = ['a cat', 'a dog wearing a hat']
+    context = multiprocessing.get_context('spawn')
+    cache = shared_memory_cache.SharedMemoryConditioningCache()
+    cache.configure(name, 1024 * 1024)
+    try:
+        writers = [context.Process(target=_put_in_worker, args=(name, prompt)) for prompt in prompts]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+            assert writer.exitcode == 0
+
+        assert cache.stats()['entries'] == len(prompts), cache.stats()
+
+        results = context.Queue()
+        reader = context.Process(target=_get_in_worker, args=(name, prompts + ['missing'], results))
+        reader.start()
+        actual = dict(results.get(timeout=60) for _ in range(len(prompts) + 1))
+        reader.join()
+
+        assert actual.pop('missing') == 'missing'
+        assert actual == dict.fromkeys(prompts), actual
+    finally:
+        cache.clear()
+        shared_memory_cache.unlink(name)
+
+
+def run_eviction_tests():
+    if shared_memory_cache.fcntl is None:
+        return
+
+    name = f'prompt_fusion_test_eviction_{os.getpid()}'
+    cache = shared_memory_cache.SharedMemoryConditioningCache()
+    cache.configure(name, 20 * 1024)
+    try:
+        for prompt in ['a', 'bb', 'ccc']:
+            cache.put(prompt, _create_schedules(prompt))
+        assert cache.get('a', 'cpu') is None, 'least recently used entry should be evicted first'
+        assert cache.get('ccc', 'cpu') is not None
+        assert cache.stats()['bytes'] <= 20 * 1024
+    finally:
+        cache.clear()
+        shared_memory_cache.unlink(name)
+
+
+def run_tests():
+    run_cross_process_tests()
+    run_eviction_tests()
@@ -0,0 +1,16 @@
+from collections import namedtuple
+
+
+ScheduledPromptConditioning = namedtuple('ScheduledPromptConditioning', ['end_at_step', 'cond'])
+
+
+def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=None, use_old_scheduling=False):
+    return [[[hires_steps or base_steps, prompt]] for prompt in prompts]
+
+
+def get_learned_conditioning(model, prompts, steps, *args, **kwargs):
+    raise NotImplementedError
+
+
+def get_multicond_learned_conditioning(model, prompts, steps, *args, **kwargs):
+    raise NotImplementedError
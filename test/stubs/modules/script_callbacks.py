@@ -0,0 +1,10 @@
+def on_script_unloaded(callback):
+    pass
+
+
+def on_ui_settings(callback):
+    pass
+
+
+def on_app_started(callback):
+    pass
@@ -0,0 +1,5 @@
+AlwaysVisible = object()
+
+
+class Script:
+    pass
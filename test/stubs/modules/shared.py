@@ -0,0 +1,20 @@
+class Options:
+    def __init__(self):
+        self.data = {}
+
+    def __getattr__(self, item):
+        try:
+            return self.__dict__['data'][item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def add_option(self, key, info):
+        self.data.setdefault(key, info.default)
+
+
+class OptionInfo:
+    def __init__(self, default=None, label='', component=None, component_args=None, section=None, **kwargs):
+        self.default = default
+
+
+opts = Options()